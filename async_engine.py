@@ -0,0 +1,241 @@
+"""
+asyncio engine for the Discord gateway.
+
+The threaded engine in lolbot.py runs a heartbeat thread, a read thread
+per connection, and a main loop that sleeps through reconnects. This
+engine runs the websocket reader, heartbeat, reconnect and dispatch as
+coroutines on a single event loop instead.
+
+Plugins see no difference: events are passed to plugin_handler.handle()
+exactly as they are in the threaded engine.
+
+Requires aiohttp (python 3 only). Select it with `lolbot.py --engine asyncio`
+or by setting ENGINE = "asyncio" in config.py.
+"""
+
+import asyncio
+import logging
+import signal
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import async_utils
+import capture
+import codec
+import config
+import gateway
+import metrics
+import plugin_handler
+
+# How often (in seconds) to check whether the plugins have caught up,
+# while they're too backed up to take more events
+BACKLOG_POLL = 0.05
+
+class GatewayError(Exception):
+    """Raised when the websocket dies or Discord asks us to reconnect."""
+
+class ZombieError(GatewayError):
+    """Raised when Discord stops acknowledging our heartbeats."""
+
+async def socket_send(wsock, msg):
+    """Send a message to the websocket.
+    
+    `msg` can be a string or a dictionary, but must represent a
+    complete Discord API message.
+    """
+    logging.debug("websocket send: %s", msg)
+    if not isinstance(msg, str):
+        msg = codec.dumps(msg)
+    await wsock.send_str(msg)
+
+async def websocket_connect(http, session):
+    """Connect to the websocket, login.
+    
+    Returns the websocket, the heartbeat interval in seconds, and the
+    gateway.Inflater that must decode everything read from it.
+    """
+    # Get the websocket URL, cached from Discord. The first call makes a
+    # blocking HTTP request, so keep it off the event loop
+    loop = asyncio.get_event_loop()
+    ws_url = await loop.run_in_executor(None, gateway.connect_url, session)
+    
+    # Connect to server
+    logging.info("Connecting to websocket server at %s ...", ws_url)
+    wsock = await asyncio.wait_for(
+        http.ws_connect(ws_url, origin="https://discord.com"),
+        config.WS_TIMEOUT,
+        )
+    logging.debug("Connected")
+    
+    try:
+        # Get welcome packet, stash heartbeat interval
+        inflater = gateway.Inflater()
+        hello = None
+        while hello is None:
+            hello = inflater.feed(await receive(wsock, config.WS_TIMEOUT))
+        hbi = gateway.parse_hello(hello)
+        
+        # Login
+        await socket_send(wsock, gateway.login_payload(session))
+    except BaseException:
+        await wsock.close()
+        raise
+    return wsock, hbi, inflater
+
+async def receive(wsock, timeout):
+    """Return the next text or binary frame from the websocket."""
+    incoming = await wsock.receive(timeout=timeout)
+    if incoming.type == aiohttp.WSMsgType.CLOSE:
+        raise gateway.ConnectionClosed(incoming.data)
+    if incoming.type not in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+        raise GatewayError("websocket closed: %s %s" % (incoming.type, incoming.data))
+    return incoming.data
+
+async def heartbeater(wsock, session, interval):
+    """Loop forever, sending heartbeats. `interval` is in seconds.
+    
+    Raises ZombieError if a heartbeat isn't acknowledged by the time the
+    next one is due.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        if gateway.is_zombie(session):
+            raise ZombieError("missed a heartbeat ACK")
+        await socket_send(wsock, gateway.heartbeat_payload(session))
+        gateway.heartbeat_sent(session)
+
+async def readloop(wsock, inflater, session, hbi):
+    """Loop over the websocket, passing events on to plugins.
+    
+    Only returns by raising, when the websocket dies or the session
+    needs to be re-established.
+    """
+    while True:
+        # The websocket is considered dead after 2*hbi of inactivity
+        incoming = inflater.feed(await receive(wsock, 2*hbi))
+        if incoming is None:
+            # Only part of a compressed payload, wait for the rest
+            continue
+        logging.debug("websocket recv: %s", incoming)
+        capture.record(session["shard"][0], incoming)
+        content = codec.loads(incoming)
+        
+        action = gateway.process_event(session, content)
+        # Rejected login or rejected heartbeat - disconnect and try again
+        if action == gateway.RECONNECT:
+            raise GatewayError("Discord asked us to reconnect")
+        
+        # Pass to plugins, but first stop reading until they have room,
+        # pushing back on the websocket rather than dropping events
+        elif action == gateway.DISPATCH:
+            if not plugin_handler.has_room():
+                session["paused"] = True
+                metrics.incr("gateway.paused")
+                while not plugin_handler.has_room():
+                    await asyncio.sleep(BACKLOG_POLL)
+                session["paused"] = False
+            plugin_handler.handle(content)
+
+async def run_connection(http, session):
+    """Connect, then run the reader and heartbeat until either one dies."""
+    wsock, hbi, inflater = await websocket_connect(http, session)
+    gateway.set_connected(session, True)
+    tasks = [
+        asyncio.ensure_future(readloop(wsock, inflater, session, hbi)),
+        asyncio.ensure_future(heartbeater(wsock, session, hbi)),
+        ]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    finally:
+        gateway.set_connected(session, False)
+        for task in tasks:
+            task.cancel()
+        await wsock.close()
+
+async def run_shard(http, session, delay):
+    """Keep one shard's gateway connection up until cancelled.
+    
+    Waits `delay` seconds before the first connection, so shards don't
+    all identify at once.
+    """
+    shard_id = session["shard"][0]
+    await asyncio.sleep(delay)
+    while True:
+        try:
+            await run_connection(http, session)
+        except asyncio.CancelledError:
+            raise
+        except ZombieError as err:
+            logging.warning("Shard %s %s", shard_id, err)
+            metrics.incr("gateway.zombies")
+        except gateway.ConnectionClosed as err:
+            logging.warning("Shard %s %s", shard_id, err)
+            # Some close codes mean the session can't be resumed, or
+            # (by raising FatalCloseError) that we should stop
+            gateway.connection_closed(session, err.code)
+        except Exception as err:
+            logging.warning("Shard %s websocket appears to have died: %s %s", shard_id, type(err), err)
+        metrics.incr("gateway.reconnects")
+        delay = gateway.reconnect_delay(session)
+        logging.warning("Shard %s reconnecting in %.1fs...", shard_id, delay)
+        # Only this coroutine waits, so other shards and anything else
+        # on the loop carry on regardless
+        await asyncio.sleep(delay)
+
+async def run(shard_ids, shard_count):
+    """Run the given shards until cancelled.
+    
+    Every shard dispatches to plugin_handler.handle() from this one
+    event loop.
+    """
+    # Fetch Discord's limits (a blocking HTTP request) before spacing the
+    # identifies out within them
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, gateway.get_identify_limiter)
+    # Async plugins share our loop
+    async_utils.set_loop(loop)
+    async with aiohttp.ClientSession() as http:
+        shards = []
+        for shard_id in shard_ids:
+            session = gateway.new_session(shard_id, shard_count)
+            shards.append(asyncio.ensure_future(
+                run_shard(http, session, gateway.identify_delay(session))))
+        try:
+            await asyncio.gather(*shards)
+        finally:
+            # If one shard hit a fatal error, stop the rest too
+            for shard in shards:
+                shard.cancel()
+
+def main(shard_ids=None, shard_count=None):
+    """Run the given shards (by default, all of them) on an asyncio event
+    loop until SIGINT.
+    """
+    if aiohttp is None:
+        raise RuntimeError("The asyncio engine requires aiohttp, please install it")
+    
+    if shard_count is None:
+        shard_count = gateway.get_shard_count()
+    if shard_ids is None:
+        shard_ids = range(shard_count)
+    
+    # Initialise plugins from the "plugins" directory
+    plugin_handler.load("plugins")
+    
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    task = loop.create_task(run(shard_ids, shard_count))
+    # Handle signals gracefully
+    loop.add_signal_handler(signal.SIGINT, task.cancel)
+    loop.add_signal_handler(signal.SIGHUP, loop.run_in_executor, None, plugin_handler.reload)
+    try:
+        loop.run_until_complete(task)
+    except asyncio.CancelledError:
+        logging.info("Main loop stopping...")
+    finally:
+        loop.close()
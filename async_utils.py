@@ -0,0 +1,140 @@
+"""
+Support for async plugins (python 3 only).
+
+Commands and handlers can be `async def` functions. Instead of taking a
+worker thread each, they all run on one shared event loop: the asyncio
+engine's own loop, or with the thread engine, a loop in a background
+thread started the first time it's needed. They should talk to Discord
+with the coroutines here (also available as bot_utils.reply_async and
+bot_utils.get_dm_async), which use aiohttp if it's installed. Without
+aiohttp, requests are made from the loop's executor threads instead.
+
+Async handlers keep the same ordering as sync ones: an event isn't
+handled until the handler has finished with the last one with the same
+key.
+"""
+
+import asyncio
+import logging
+import threading
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import bot_utils
+import codec
+import config
+import metrics
+
+# The event loop async plugins run on
+LOOP = None
+_LOOP_LOCK = threading.Lock()
+
+# aiohttp session for REST requests, tied to LOOP
+_HTTP = None
+
+# Ordering key -> the last task started with that key
+_TAILS = {}
+
+def set_loop(loop):
+    """Run async plugins on the given (running) event loop."""
+    global LOOP, _HTTP
+    with _LOOP_LOCK:
+        LOOP = loop
+        _HTTP = None
+
+def get_loop():
+    """Return the event loop async plugins run on, starting one if need be."""
+    global LOOP
+    with _LOOP_LOCK:
+        if LOOP is None:
+            LOOP = asyncio.new_event_loop()
+            thread = threading.Thread(target=LOOP.run_forever, name="async-plugins")
+            thread.setDaemon(True)
+            thread.start()
+        return LOOP
+
+def spawn(coro, key=None, timeout=None, on_failure=None):
+    """Run a coroutine on the plugin loop. Safe to call from any thread.
+    
+    Coroutines spawned with the same key run one after another. One that
+    runs for more than `timeout` seconds is cancelled. `on_failure`, if
+    set, is called with "errors" if the coroutine raises an exception,
+    or "timeouts" if it's cancelled.
+    """
+    metrics.incr("plugins.async.tasks")
+    asyncio.run_coroutine_threadsafe(_run(coro, key, timeout, on_failure), get_loop())
+
+async def _run(coro, key, timeout=None, on_failure=None):
+    """Run a plugin coroutine once the one before it with the same key is done."""
+    previous = None
+    if key is not None:
+        previous = _TAILS.get(key)
+        task = _TAILS[key] = asyncio.current_task()
+    try:
+        if previous is not None:
+            await asyncio.wait([previous])
+        await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        logging.error("%s took longer than %ss, cancelled it", getattr(coro, "__qualname__", coro), timeout)
+        metrics.incr("plugins.async.timeouts")
+        if on_failure:
+            on_failure("timeouts")
+    except Exception:
+        logging.exception("Error in %s", getattr(coro, "__qualname__", coro))
+        if on_failure:
+            on_failure("errors")
+    finally:
+        if key is not None and _TAILS.get(key) is task:
+            del _TAILS[key]
+
+async def request(method, path, **kwargs):
+    """Make a request to the Discord REST API, and return the decoded
+    JSON response.
+    
+    `path` is relative to the API root, e.g. "/channels/". A `json`
+    argument is encoded as the request body.
+    """
+    global _HTTP
+    if aiohttp is None:
+        # Fall back to requests, in a thread
+        loop = asyncio.get_event_loop()
+        response = await loop.run_in_executor(None,
+            lambda: bot_utils.HTTP_SESSION.request(method, path, **kwargs))
+        response.raise_for_status()
+        return response.json()
+    
+    if _HTTP is None:
+        _HTTP = aiohttp.ClientSession(headers={"Authorization": "Bot " + config.BOT_TOKEN})
+    if kwargs.get("json") is not None:
+        kwargs["data"] = codec.dumpb(kwargs.pop("json"))
+        kwargs["headers"] = dict(kwargs.get("headers") or {})
+        kwargs["headers"].setdefault("Content-Type", "application/json")
+    async with _HTTP.request(method, config.BASE_URL + path, **kwargs) as response:
+        response.raise_for_status()
+        return codec.loads(await response.read())
+
+async def reply(msg, response):
+    """Async version of bot_utils.reply(). Returns the message sent."""
+    channel_id = msg.get("d").get("channel_id")
+    return await request("POST", "/channels/{0}/messages".format(channel_id),
+        json={"content": response},
+        )
+
+async def get_dm(user):
+    """Async version of bot_utils.get_dm()."""
+    # User ID could be a naked ID or a bracket-wrapped format
+    matches = bot_utils.MENTION_RE.match(user)
+    if matches:
+        user = matches.group(1)
+    if user in bot_utils.DM_CACHE:
+        return bot_utils.DM_CACHE[user]
+    
+    response = await request("POST", "/users/@me/channels",
+        json={"recipient_id": user},
+        )
+    dest = response["id"]
+    bot_utils.DM_CACHE[user] = dest
+    return dest
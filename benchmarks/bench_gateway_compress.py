@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+"""
+Compare plain JSON gateway traffic against zlib-stream transport
+compression: bytes on the wire, and CPU spent decoding.
+
+The traffic is synthetic but shaped like a busy bot's: a burst of
+GUILD_CREATEs (as after READY), then a long tail of presence updates,
+typing events and messages. Compressed frames are produced the way
+Discord does it - one zlib stream per connection, flushed with
+Z_SYNC_FLUSH after every payload - and optionally chopped into several
+websocket frames so the multi-frame path is measured too.
+
+Run from the bot directory (it needs config.py):
+    python benchmarks/bench_gateway_compress.py [--guilds N] [--events N]
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import codec
+import gateway
+
+# CPU time, not wall time
+cpu_clock = getattr(time, "process_time", None) or time.clock
+
+def snowflake():
+    return str(random.randint(10**17, 10**18))
+
+def make_user():
+    return {
+        "id": snowflake(),
+        "username": "user%d" % random.randint(0, 10**6),
+        "discriminator": "%04d" % random.randint(0, 9999),
+        "avatar": "%032x" % random.getrandbits(128),
+        }
+
+def make_presence(guild_id, user):
+    return {
+        "user": {"id": user["id"]},
+        "guild_id": guild_id,
+        "status": random.choice(["online", "idle", "dnd"]),
+        "activities": [{"name": random.choice(["Minecraft", "Spotify", "Visual Studio Code"]), "type": 0}],
+        "client_status": {"desktop": "online"},
+        }
+
+def make_guild_create(seq, members):
+    guild_id = snowflake()
+    users = [make_user() for _ in range(members)]
+    return {"op": 0, "s": seq, "t": "GUILD_CREATE", "d": {
+        "id": guild_id,
+        "name": "Guild %s" % guild_id,
+        "member_count": members,
+        "channels": [{"id": snowflake(), "name": "channel-%d" % i, "type": 0, "position": i}
+            for i in range(30)],
+        "members": [{"user": user, "roles": [snowflake()], "joined_at": "2020-01-01T00:00:00+00:00",
+            "deaf": False, "mute": False} for user in users],
+        "presences": [make_presence(guild_id, user) for user in users],
+        }}
+
+def make_event(seq):
+    kind = random.random()
+    user = make_user()
+    if kind < 0.7:
+        return {"op": 0, "s": seq, "t": "PRESENCE_UPDATE", "d": make_presence(snowflake(), user)}
+    elif kind < 0.85:
+        return {"op": 0, "s": seq, "t": "TYPING_START", "d": {
+            "channel_id": snowflake(), "guild_id": snowflake(), "user_id": user["id"],
+            "timestamp": int(time.time())}}
+    return {"op": 0, "s": seq, "t": "MESSAGE_CREATE", "d": {
+        "id": snowflake(), "channel_id": snowflake(), "guild_id": snowflake(), "author": user,
+        "content": "message number %d" % seq, "timestamp": "2020-01-01T00:00:00+00:00",
+        "mentions": [], "attachments": [], "embeds": []}}
+
+def make_traffic(guilds, members, events):
+    payloads = [make_guild_create(seq, members) for seq in range(1, guilds + 1)]
+    payloads += [make_event(seq) for seq in range(guilds + 1, guilds + events + 1)]
+    return [json.dumps(p) for p in payloads]
+
+def compress_stream(payloads, frame_size):
+    """Compress payloads as one zlib-stream, return a list of websocket frames."""
+    compressor = zlib.compressobj()
+    frames = []
+    for payload in payloads:
+        data = compressor.compress(payload.encode('utf-8')) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        for i in range(0, len(data), frame_size):
+            frames.append(data[i:i + frame_size])
+    return frames
+
+def decode_all(frames, compress):
+    """Decode every frame, return (payload count, CPU seconds)."""
+    inflater = gateway.Inflater(compress)
+    count = 0
+    start = cpu_clock()
+    for frame in frames:
+        payload = inflater.feed(frame)
+        if payload is not None:
+            codec.loads(payload)
+            count += 1
+    return count, cpu_clock() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument("--guilds", type=int, default=50, help="GUILD_CREATE payloads to send")
+    parser.add_argument("--members", type=int, default=250, help="members per guild")
+    parser.add_argument("--events", type=int, default=20000, help="events after the guild burst")
+    parser.add_argument("--frame-size", type=int, default=16384, help="max websocket frame size")
+    parser.add_argument("--repeat", type=int, default=3, help="take the best of this many runs")
+    args = parser.parse_args()
+    
+    random.seed(0)
+    payloads = make_traffic(args.guilds, args.members, args.events)
+    plain = [p.encode('utf-8') for p in payloads]
+    compressed = compress_stream(payloads, args.frame_size)
+    
+    plain_bytes = sum(len(f) for f in plain)
+    zlib_bytes = sum(len(f) for f in compressed)
+    plain_cpu = min(decode_all(plain, False)[1] for _ in range(args.repeat))
+    zlib_cpu = min(decode_all(compressed, True)[1] for _ in range(args.repeat))
+    assert decode_all(compressed, True)[0] == len(payloads)
+    
+    print("%d payloads (%d guild creates, %d events), decoded with %s" % (
+        len(payloads), args.guilds, args.events, codec.NAME))
+    print("%-12s %14s %10s %14s" % ("mode", "wire bytes", "frames", "decode CPU"))
+    print("%-12s %14d %10d %12.3fs" % ("plain", plain_bytes, len(plain), plain_cpu))
+    print("%-12s %14d %10d %12.3fs" % ("zlib-stream", zlib_bytes, len(compressed), zlib_cpu))
+    print("compression ratio %.1fx, decode CPU %.2fx" % (plain_bytes / zlib_bytes, zlib_cpu / plain_cpu))
+
+if __name__ == '__main__':
+    main()
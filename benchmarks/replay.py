@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+"""
+Replay a gateway capture (see capture.py) through the plugins.
+
+Every recorded payload goes through the same path as live traffic -
+gateway.process_event(), then plugin_handler.handle() - but
+bot_utils.reply() and the REST session are stubbed out, so nothing is
+sent to Discord. Prints dispatch throughput, and the latency from each
+message being dispatched to the plugin replying to it.
+
+Run from the bot directory (it needs config.py and the plugins):
+    python benchmarks/replay.py capture.gz            # as fast as possible
+    python benchmarks/replay.py --speed 1 capture.gz  # at the original speed
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot_utils
+import capture
+import codec
+import config
+import gateway
+import metrics
+import plugin_handler
+
+
+class FakeResponse(object):
+    """Stands in for a requests.Response from Discord."""
+    status_code = 200
+    content = b'{"id": "0", "channel_id": "0"}'
+    def json(self, **kwargs):
+        return codec.loads(self.content)
+    def raise_for_status(self):
+        pass
+
+class FakeSession(object):
+    """Stands in for bot_utils.HTTP_SESSION, counting requests instead."""
+    def __init__(self):
+        self.requests = 0
+    def request(self, method, url, **kwargs):
+        self.requests += 1
+        return FakeResponse()
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+class ReplyRecorder(object):
+    """Replaces bot_utils.reply(), noting how long each reply took to arrive."""
+    def __init__(self):
+        self.dispatched = {}
+        self.latencies = []
+        self._lock = threading.Lock()
+    
+    def dispatching(self, content):
+        """Note when a message was passed to the plugins."""
+        msg_id = (content.get("d") or {}).get("id")
+        if msg_id:
+            self.dispatched[msg_id] = time.time()
+    
+    def __call__(self, msg, response):
+        now = time.time()
+        sent = self.dispatched.get(msg.get("d", {}).get("id"))
+        with self._lock:
+            if sent is not None:
+                self.latencies.append(now - sent)
+        return FakeResponse()
+
+def percentile(values, pct):
+    """Return the pct'th percentile of a sorted list."""
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def wait_for_handlers(timeout):
+    """Wait until every handler has finished, or timeout."""
+    pool = plugin_handler.get_pool()
+    deadline = time.time() + timeout
+    while not pool.idle() and time.time() < deadline:
+        time.sleep(0.01)
+
+def replay(fname, speed, recorder):
+    """Replay a capture, return the number of frames and dispatches."""
+    sessions = {}
+    frames = dispatched = 0
+    first = start = None
+    for timestamp, shard_id, payload in capture.read(fname):
+        if first is None:
+            first, start = timestamp, time.time()
+        elif speed:
+            # Keep to the original timing, scaled by speed
+            delay = (timestamp - first) / speed - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+        frames += 1
+        
+        if shard_id not in sessions:
+            sessions[shard_id] = gateway.new_session(shard_id)
+        session = sessions[shard_id]
+        content = codec.loads(payload)
+        if gateway.process_event(session, content) == gateway.DISPATCH:
+            # Hold events back while the handlers are backed up, as the
+            # thread engine does, rather than have them dropped
+            while not plugin_handler.has_room():
+                time.sleep(0.001)
+            recorder.dispatching(content)
+            plugin_handler.handle(content)
+            dispatched += 1
+    return frames, dispatched
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument("capture", help="capture file recorded with lolbot.py --record")
+    parser.add_argument("--speed", type=float, default=0,
+        help="replay speed relative to the original (0 means as fast as possible)")
+    parser.add_argument("--plugins", default="plugins", help="plugin directory to load")
+    parser.add_argument("--timeout", type=float, default=30,
+        help="seconds to wait for handlers to finish after the last event")
+    parser.add_argument("--rate-limits", action="store_true",
+        help="apply the configured command rate limits (a capture's few senders would mostly be limited)")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    
+    # Stub out everything that talks to Discord
+    session = FakeSession()
+    recorder = ReplyRecorder()
+    bot_utils.HTTP_SESSION = session
+    bot_utils.reply = recorder
+    try:
+        # Without aiohttp, async plugins' requests go through
+        # HTTP_SESSION too
+        import async_utils
+        async_utils.aiohttp = None
+    except SyntaxError:
+        # No async plugins on python 2
+        pass
+    if not args.rate_limits:
+        plugin_handler.LIMITS = (None, None, {})
+    # Played back flat out, a capture crams minutes of each channel's
+    # traffic into a moment, far more than any channel ever has waiting
+    if not args.speed:
+        config.PLUGIN_QUEUE_PER_KEY = getattr(config, "PLUGIN_QUEUE_SIZE", 1000)
+    
+    plugin_handler.load(args.plugins)
+    
+    # Time until every handler has finished, not just until the last
+    # event was dispatched
+    start = time.time()
+    frames, dispatched = replay(args.capture, args.speed, recorder)
+    wait_for_handlers(args.timeout)
+    elapsed = time.time() - start
+    
+    latencies = sorted(recorder.latencies)
+    counters = metrics.snapshot()["counters"]
+    print("%d frames, %d dispatched in %.3fs (%.0f events/s)" % (
+        frames, dispatched, elapsed, dispatched / elapsed if elapsed else 0))
+    print("%d replies, %d other REST requests" % (len(latencies), session.requests))
+    if latencies:
+        print("reply latency ms: p50 %.2f  p95 %.2f  p99 %.2f  max %.2f" % tuple(
+            1000 * percentile(latencies, pct) for pct in (50, 95, 99, 100)))
+    print("sequence: %d duplicates dropped, %d gaps" % (
+        counters.get("gateway.seq.duplicates", 0), counters.get("gateway.seq.gaps", 0)))
+    if args.rate_limits:
+        print("rate limited: %d commands" % sum(
+            count for name, count in counters.items() if name.endswith(".limited")))
+
+if __name__ == '__main__':
+    main()
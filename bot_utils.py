@@ -1,31 +1,73 @@
 """
 Functions that might be useful for plugins.
+
+Commands and handlers can also be `async def` functions (on python 3),
+in which case they run on a shared event loop rather than taking a
+worker thread each, and should use reply_async() and get_dm_async().
+See async_utils.py.
 """
 
 from functools import wraps
+import inspect
 import logging
 import re
 import requests
+import threading
 try:
     import urllib3
 except:
     urllib3 = None
 
+import codec
 import config
 
 # List of all the !commands registered, and their handler functions
 COMMANDS = {}
 
-# Lets dynamic command handlers register a regex that they'll match
-# This is to stop plugin_handler complaining about unknown commands
+# Dynamic command handlers, as (regex, function) pairs, registered with
+# dynamic_command(). A bare regex string just stops plugin_handler
+# complaining about commands that match it
 RECOMMANDS = []
 
 # List of all the event handlers registered
 HANDLERS = set()
 
+# The event types each handler has asked for, or None for all events
+HANDLER_EVENTS = {}
+
+# Each handler's ordering key function, see handler()
+HANDLER_KEYS = {}
+
+# While plugin_handler imports a plugin, the decorators below register
+# into that import's own registries instead of the live ones above,
+# which carry on serving events until the new plugin is swapped in
+_STAGING = threading.local()
+
+def staging(registries):
+    """Have decorators on this thread register into `registries` (a dict
+    of registry name -> registry) from now on, or into the live ones
+    again if it's None.
+    """
+    _STAGING.registries = registries
+
+def _registry(name):
+    """Return the registry that decorators on this thread add to."""
+    staged = getattr(_STAGING, "registries", None)
+    if staged is not None:
+        return staged[name]
+    return globals()[name]
+
 # Cache DM channels we have open
 DM_CACHE = {}
 
+# Discord's markup for mentions of users (<@id>, or <@!id> by nickname),
+# channels (<#id>) and roles (<@&id>)
+MENTION_RE = re.compile(r"<@!?(\d+)>")
+CHANNEL_RE = re.compile(r"<#(\d+)>")
+ROLE_RE = re.compile(r"<@&(\d+)>")
+# Any kind of mention, or an ID on its own
+ID_RE = re.compile(r"(?:<(?:@[!&]?|#)(\d+)>|(\d+))$")
+
 class DiscordSession(requests.Session):
     """Custom Requests session that adds HTTP auth header, and adds the
     base URL to any requests.
@@ -48,13 +90,95 @@ class DiscordSession(requests.Session):
     
     def request(self, method, url, **kwargs):
         modified_url = self.url_base + url
-        return super(DiscordSession, self).request(method, modified_url, **kwargs)
+        # Encode JSON bodies with our codec rather than requests' own json
+        if kwargs.get("json") is not None:
+            kwargs["data"] = codec.dumpb(kwargs.pop("json"))
+            kwargs["headers"] = dict(kwargs.get("headers") or {})
+            kwargs["headers"].setdefault("Content-Type", "application/json")
+        response = super(DiscordSession, self).request(method, modified_url, **kwargs)
+        # ...and decode responses with it too
+        response.json = lambda **kwargs: codec.loads(response.content)
+        return response
 
 # A custom requests.Session instance
 # which handles Discord's HTTP auth and URL prefix for you
 # Make requests to the root-relative API paths, e.g. "/channels/"
 HTTP_SESSION = DiscordSession(config.BASE_URL, config.BOT_TOKEN)
 
+def parse_id(word):
+    """Return the ID in a user, channel or role mention, or a bare ID, or
+    None if `word` isn't one.
+    """
+    match = ID_RE.match(word)
+    if not match:
+        return None
+    return match.group(1) or match.group(2)
+
+class CommandContext(dict):
+    """A !command message, parsed once by plugin_handler for whichever
+    command it's for.
+    
+    It's a read-only copy of the message, so it can be used anywhere the
+    message can, with the parsed parts as attributes:
+     * command: the command word, in lower case, without COMMAND_CHAR
+     * text: everything after the command word
+     * args: `text` split on whitespace
+     * mentions, channels, roles: the IDs of the users, channels and
+       roles mentioned in `text`
+     * ids: the IDs in `args`, given bare or as mentions
+    Only `command` and `text` are worked out up front; the rest are
+    worked out the first time they're used.
+    """
+    __slots__ = ("_command", "_text", "_args", "_mentions", "_channels", "_roles", "_ids")
+    
+    def __init__(self, msg, command, text):
+        super(CommandContext, self).__init__(msg)
+        self._command = command
+        self._text = text
+        self._args = self._mentions = self._channels = self._roles = self._ids = None
+    
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("CommandContext is read-only")
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+    
+    @property
+    def command(self):
+        return self._command
+    
+    @property
+    def text(self):
+        return self._text
+    
+    @property
+    def args(self):
+        if self._args is None:
+            self._args = tuple(self._text.split())
+        return self._args
+    
+    @property
+    def mentions(self):
+        if self._mentions is None:
+            self._mentions = tuple(MENTION_RE.findall(self._text))
+        return self._mentions
+    
+    @property
+    def channels(self):
+        if self._channels is None:
+            self._channels = tuple(CHANNEL_RE.findall(self._text))
+        return self._channels
+    
+    @property
+    def roles(self):
+        if self._roles is None:
+            self._roles = tuple(ROLE_RE.findall(self._text))
+        return self._roles
+    
+    @property
+    def ids(self):
+        if self._ids is None:
+            self._ids = tuple(found for found in map(parse_id, self.args) if found)
+        return self._ids
+
 def reply(msg, response):
     """Given a MESSAGE_CREATE event from discord, and a response string,
     send the response string to whichever channel/PM the original event
@@ -79,19 +203,70 @@ def reply(msg, response):
         else:
             raise
 
+def reply_async(msg, response):
+    """Async version of reply(), for async plugins. Returns the sent
+    message, decoded.
+    """
+    import async_utils
+    return async_utils.reply(msg, response)
+
+def is_async(func):
+    """Is this an `async def` function?"""
+    return getattr(inspect, "iscoroutinefunction", lambda f: False)(func)
+
+def is_awaitable(result):
+    """Did calling a plugin function give us something to await?"""
+    return getattr(inspect, "isawaitable", lambda r: False)(result)
+
 def command(cword):
     """Decorator to flag a function as handling a given !command."""
     def decor(func):
-        COMMANDS[cword.lower()] = func
+        _registry("COMMANDS")[cword.lower()] = func
         logging.info("Loaded command %s", cword)
         return func
     return decor
 
-def handler(func):
-    """Decorator to flag a function as handling all Discord events."""
-    HANDLERS.add(func)
-    logging.info("Loaded handler '%s' from %s", func.__name__, func.__globals__.get("__file__"))
-    return func
+def dynamic_command(regex):
+    """Decorator to flag a function as handling any !command matching a regex.
+    
+    The function is called with the message, and the match of the regex
+    against the (lower-cased) command word.
+    """
+    def decor(func):
+        _registry("RECOMMANDS").append((regex, func))
+        logging.info("Loaded dynamic command %s", regex)
+        return func
+    return decor
+
+def channel_key(msg):
+    """Default ordering key for handlers: the event's channel."""
+    return (msg.get("d") or {}).get("channel_id")
+
+def handler(*events, **kwargs):
+    """Decorator to flag a function as handling Discord events.
+    
+    Give the event types the function needs, e.g.
+    `@handler("MESSAGE_CREATE")`, so the bot only subscribes to the
+    gateway intents it needs, and the function is only called for those
+    events. A bare `@handler` asks for every event.
+    
+    The function is never called for an event while it's still handling
+    an earlier one with the same key; by default the key is the channel
+    (see channel_key()). Pass `key` to order by something else, or
+    key=None to handle every event in parallel.
+    """
+    # Called as a bare @handler
+    if len(events) == 1 and callable(events[0]) and not kwargs:
+        return handler()(events[0])
+    key = kwargs.get("key", channel_key)
+    
+    def decor(func):
+        _registry("HANDLERS").add(func)
+        _registry("HANDLER_EVENTS")[func] = frozenset(events) or None
+        _registry("HANDLER_KEYS")[func] = key
+        logging.info("Loaded handler '%s' from %s", func.__name__, func.__globals__.get("__file__"))
+        return func
+    return decor
 
 def admin_only(func):
     """Decorator to flag a function as only usable by ADMINS."""
@@ -107,7 +282,7 @@ def admin_only(func):
 def get_dm(user):
     """Given a userid, get a DM session id."""
     # User ID could be a naked ID or a bracket-wrapped format
-    matches = re.match(r'\<@(\d+)\>', user)
+    matches = MENTION_RE.match(user)
     if matches:
         user = matches.group(1)
     if user in DM_CACHE:
@@ -119,3 +294,8 @@ def get_dm(user):
     dest = response.json()["id"]
     DM_CACHE[user] = dest
     return dest
+
+def get_dm_async(user):
+    """Async version of get_dm(), for async plugins."""
+    import async_utils
+    return async_utils.get_dm(user)
@@ -0,0 +1,85 @@
+"""
+Gateway traffic capture.
+
+When recording is switched on (`lolbot.py --record FILE`, or RECORD_FILE
+in config.py), every payload read from the gateway is appended to a
+gzip-compressed capture file, along with the time it arrived and the
+shard it arrived on. benchmarks/replay.py can then play a capture back
+through the plugins.
+
+Each record is a header of (timestamp, shard ID, payload length),
+packed with HEADER, followed by the payload exactly as it was read
+(after zlib-stream decompression, if any).
+"""
+
+import gzip
+import logging
+import struct
+import threading
+import time
+
+# Record header: arrival time, shard ID, payload length
+HEADER = struct.Struct("<dHI")
+
+# How often to flush the capture file, in seconds
+FLUSH_INTERVAL = 5
+
+class Recorder(object):
+    """Appends gateway payloads to a capture file. Thread-safe."""
+    def __init__(self, fname):
+        self.fname = fname
+        self._file = gzip.open(fname, 'ab')
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+    
+    def write(self, shard_id, payload):
+        """Record a payload that was just read from the given shard."""
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        now = time.time()
+        with self._lock:
+            self._file.write(HEADER.pack(now, shard_id, len(payload)))
+            self._file.write(payload)
+            if now - self._last_flush >= FLUSH_INTERVAL:
+                self._file.flush()
+                self._last_flush = now
+    
+    def close(self):
+        """Flush and close the capture file."""
+        with self._lock:
+            self._file.close()
+
+# The active Recorder, if we're recording
+RECORDER = None
+
+def start(fname):
+    """Start recording gateway traffic to the given file."""
+    global RECORDER
+    logging.info("Recording gateway traffic to %s", fname)
+    RECORDER = Recorder(fname)
+
+def stop():
+    """Stop recording, if we were."""
+    global RECORDER
+    if RECORDER:
+        RECORDER.close()
+        RECORDER = None
+
+def record(shard_id, payload):
+    """Record a payload if recording is switched on, otherwise do nothing."""
+    if RECORDER:
+        RECORDER.write(shard_id, payload)
+
+def read(fname):
+    """Yield (timestamp, shard ID, payload) for every record in a capture file."""
+    with gzip.open(fname, 'rb') as f:
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                # End of file, or a record cut short by a crash
+                break
+            timestamp, shard_id, length = HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                break
+            yield timestamp, shard_id, payload
@@ -0,0 +1,58 @@
+"""
+JSON encoding and decoding for the gateway and REST paths.
+
+Uses orjson or ujson if either is installed, falling back to the
+standard library's json module otherwise. To force a particular one,
+set JSON_CODEC in config.py to "orjson", "ujson" or "json".
+
+loads() accepts bytes as well as str, so raw websocket frames and HTTP
+bodies never need decoding to str first. dumps() returns a str, and
+dumpb() returns UTF-8 encoded bytes.
+"""
+
+import json
+import logging
+
+import config
+
+# Codecs to try, fastest first
+CODECS = ("orjson", "ujson", "json")
+
+def get_codec(name):
+    """Return (loads, dumps, dumpb) for the named codec.
+    
+    Raises ImportError if it isn't installed.
+    """
+    if name == "orjson":
+        import orjson
+        return orjson.loads, lambda obj: orjson.dumps(obj).decode('utf-8'), orjson.dumps
+    elif name == "ujson":
+        import ujson
+        return ujson.loads, ujson.dumps, lambda obj: ujson.dumps(obj).encode('utf-8')
+    elif name == "json":
+        def stdlib_loads(data):
+            # Older pythons' json can't take bytes
+            if isinstance(data, (bytes, bytearray)):
+                data = data.decode('utf-8')
+            return json.loads(data)
+        return stdlib_loads, json.dumps, lambda obj: json.dumps(obj).encode('utf-8')
+    raise ValueError("Unknown JSON codec %s" % name)
+
+def select(preferred=None):
+    """Switch to the preferred codec, or the fastest one installed."""
+    global NAME, loads, dumps, dumpb
+    names = CODECS
+    if preferred:
+        names = (preferred,) + CODECS
+    for name in names:
+        try:
+            loads, dumps, dumpb = get_codec(name)
+        except ImportError:
+            if name == preferred:
+                logging.warning("JSON codec %s is not installed, falling back", name)
+            continue
+        NAME = name
+        logging.debug("Using JSON codec %s", name)
+        return name
+
+select(getattr(config, "JSON_CODEC", None))
@@ -0,0 +1,228 @@
+"""
+Multi-process shard launcher.
+
+However many shards run in one process, they share one GIL and so one
+CPU core. In launcher mode the bot's shards are split into contiguous
+ranges, and each range runs in its own worker process, with its own
+gateway connections and plugin dispatch.
+
+The coordinator (the original process) does no Discord work itself. It
+restarts workers that die or stop reporting in, and combines the
+metrics every worker sends it, logging the result every
+METRICS_LOG_INTERVAL seconds (and writing it to METRICS_FILE, if set).
+"""
+
+from __future__ import division
+
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+
+import capture
+import config
+import gateway
+import metrics
+
+# py2/3 compat
+if sys.version_info[0] == 2:
+    import Queue as queue
+else:
+    import queue
+
+# How often workers report their metrics, in seconds
+REPORT_INTERVAL = 10
+
+# A worker that hasn't reported for this long is considered hung
+REPORT_TIMEOUT = 6 * REPORT_INTERVAL
+
+# Minimum number of seconds between restarts of the same worker
+RESTART_DELAY = 10
+
+# Exit code of a worker that restarting won't help (see
+# gateway.FATAL_CLOSE_CODES)
+FATAL_EXIT_CODE = 3
+
+def shard_ranges(shard_count, processes):
+    """Split shards 0..shard_count-1 into (at most) `processes` contiguous ranges."""
+    processes = max(1, min(processes, shard_count))
+    return [list(range(i * shard_count // processes, (i + 1) * shard_count // processes))
+        for i in range(processes)]
+
+def reporter(worker_id, report_queue):
+    """Loop forever, sending this worker's metrics to the coordinator."""
+    while True:
+        report_queue.put((worker_id, os.getpid(), metrics.snapshot()))
+        time.sleep(REPORT_INTERVAL)
+
+def worker_main(worker_id, shard_ids, shard_count, engine, report_queue, record=None, limiter=None):
+    """Entry point for a worker process: run our shards on the given engine.
+    
+    If `record` is given, gateway traffic is recorded to a capture file
+    named after it, with the worker ID appended. `limiter` is the
+    gateway.IdentifyLimiter shared by all workers.
+    """
+    if limiter:
+        gateway.LIMITER = limiter
+    # Don't run the coordinator's SIGHUP handler until the engine sets its own
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    thread = threading.Thread(target=reporter, args=[worker_id, report_queue])
+    thread.setDaemon(True)
+    thread.start()
+    
+    logging.info("Worker %s (pid %s) running shards %s", worker_id, os.getpid(), shard_ids)
+    if record:
+        capture.start("%s.%s" % (record, worker_id))
+    try:
+        if engine == "asyncio":
+            import async_engine
+            async_engine.main(shard_ids, shard_count)
+        else:
+            import lolbot
+            lolbot.main(shard_ids, shard_count)
+    except gateway.FatalCloseError as err:
+        logging.error("Worker %s can't connect: %s", worker_id, err)
+        sys.exit(FATAL_EXIT_CODE)
+    except Exception as err:
+        logging.error("Worker %s crashed: %s %s", worker_id, repr(err), err)
+        raise
+    finally:
+        capture.stop()
+
+class Worker(object):
+    """The coordinator's view of one worker process."""
+    def __init__(self, worker_id, shard_ids):
+        self.worker_id = worker_id
+        self.shard_ids = shard_ids
+        self.process = None
+        self.started = 0
+        self.last_report = 0
+        self.metrics = {}
+    
+    def start(self, shard_count, engine, report_queue, record=None, limiter=None):
+        """Start (or restart) the worker process."""
+        self.process = multiprocessing.Process(
+            target=worker_main,
+            args=(self.worker_id, self.shard_ids, shard_count, engine, report_queue, record, limiter),
+            name="lolbot-worker-%s" % self.worker_id,
+            )
+        self.process.daemon = True
+        self.process.start()
+        self.started = self.last_report = time.time()
+        self.metrics = {}
+    
+    def health(self):
+        """Return a summary of this worker's state."""
+        return {
+            "worker": self.worker_id,
+            "pid": self.process.pid,
+            "alive": self.process.is_alive(),
+            "shards": self.shard_ids,
+            "last_report": self.last_report,
+            }
+
+def report(workers, shard_count, limiter):
+    """Log the combined health and metrics of all workers."""
+    remaining, total, _ = limiter.budget()
+    if total:
+        metrics.set_gauge("gateway.identify.remaining", remaining)
+    combined = metrics.merge([metrics.snapshot()] + [w.metrics for w in workers if w.process.is_alive()])
+    alive = sum(1 for w in workers if w.process.is_alive())
+    connected = sum(value for name, value in combined["gauges"].items()
+        if name.startswith("gateway.shard.") and name.endswith(".connected"))
+    logging.info("%s/%s workers alive, %s/%s shards connected. Metrics: %s",
+        alive, len(workers), connected, shard_count, json.dumps(combined, sort_keys=True))
+    
+    fname = getattr(config, "METRICS_FILE", None)
+    if fname:
+        with open(fname, 'w') as f:
+            json.dump({
+                "time": time.time(),
+                "workers": [w.health() for w in workers],
+                "metrics": combined,
+                }, f)
+
+def run(processes, engine, shard_count=None, record=None):
+    """Start a worker per shard range, and look after them until SIGINT.
+    
+    If `record` is given, each worker records its gateway traffic to
+    `record`.<worker ID>.
+    """
+    if shard_count is None:
+        shard_count = gateway.get_shard_count()
+    report_interval = getattr(config, "METRICS_LOG_INTERVAL", 60)
+    
+    # Handle signals gracefully
+    stopping = threading.Event()
+    def sig_handler(signum, frame):
+        stopping.set()
+    signal.signal(signal.SIGINT, sig_handler)
+    
+    report_queue = multiprocessing.Queue()
+    # Every worker identifies through the same limiter
+    limits = gateway.get_gateway_info().get("session_start_limit") or {}
+    limiter = gateway.IdentifyLimiter(limits.get("max_concurrency", 1), shared=True)
+    if limits:
+        limiter.update(limits, time.time())
+    workers = [Worker(idx, shard_ids)
+        for idx, shard_ids in enumerate(shard_ranges(shard_count, processes))]
+    for worker in workers:
+        worker.start(shard_count, engine, report_queue, record, limiter)
+    
+    # Pass SIGHUP on to the workers, to reload their plugins
+    def reload_handler(signum, frame):
+        for worker in workers:
+            if worker.process.is_alive():
+                os.kill(worker.process.pid, signal.SIGHUP)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, reload_handler)
+    
+    last_report = time.time()
+    while not stopping.is_set():
+        # Collect metrics from the workers
+        try:
+            worker_id, pid, snapshot = report_queue.get(True, 1)
+            worker = workers[worker_id]
+            # Ignore anything that was sent before a restart
+            if worker.process.pid == pid:
+                worker.last_report = time.time()
+                worker.metrics = snapshot
+        except queue.Empty:
+            pass
+        
+        # Restart dead workers, kill hung ones
+        now = time.time()
+        for worker in workers:
+            if not worker.process.is_alive():
+                if worker.process.exitcode == FATAL_EXIT_CODE:
+                    logging.error("Worker %s (shards %s) can't connect to Discord, stopping",
+                        worker.worker_id, worker.shard_ids)
+                    stopping.set()
+                elif now - worker.started >= RESTART_DELAY:
+                    logging.warning("Worker %s (shards %s) died with exit code %s, restarting",
+                        worker.worker_id, worker.shard_ids, worker.process.exitcode)
+                    metrics.incr("coordinator.restarts")
+                    worker.start(shard_count, engine, report_queue, record, limiter)
+            elif now - worker.last_report > REPORT_TIMEOUT:
+                logging.warning("Worker %s (shards %s) stopped reporting, killing it",
+                    worker.worker_id, worker.shard_ids)
+                worker.process.terminate()
+        
+        if now - last_report >= report_interval:
+            report(workers, shard_count, limiter)
+            last_report = now
+    
+    # Shutdown
+    logging.info("Coordinator stopping workers...")
+    for worker in workers:
+        if worker.process.is_alive():
+            os.kill(worker.process.pid, signal.SIGINT)
+    for worker in workers:
+        worker.process.join(10)
+        if worker.process.is_alive():
+            worker.process.terminate()
@@ -0,0 +1,680 @@
+"""
+Discord gateway protocol helpers.
+
+These are shared by the connection engines (the threaded engine in
+lolbot.py and the asyncio engine in async_engine.py), so they must not
+block on anything other than the HTTP call in get_gateway_info(), which
+only happens the first time it's called.
+"""
+
+from collections import OrderedDict, deque
+import logging
+import multiprocessing
+import random
+import threading
+import time
+import zlib
+
+import requests
+
+import codec
+import config
+import metrics
+import plugin_handler
+
+
+# Reconnect backoff: the first retry waits up to BACKOFF_BASE seconds,
+# doubling with each failure up to BACKOFF_MAX
+BACKOFF_BASE = 1
+BACKOFF_MAX = 300
+
+# How long a /gateway/bot response is used for before refreshing it,
+# and the timeout on fetching it, in seconds
+GATEWAY_INFO_TTL = 3600
+HTTP_TIMEOUT = 10
+
+# Discord allows one identify per rate limit bucket every 5 seconds
+IDENTIFY_INTERVAL = 5
+
+# Warn when less than this fraction of the day's session starts are left
+IDENTIFY_LOW_BUDGET = 0.1
+
+# Gateway intents, and the events each one enables
+INTENTS = {
+    "GUILDS": (1 << 0, ("GUILD_CREATE", "GUILD_UPDATE", "GUILD_DELETE",
+        "GUILD_ROLE_CREATE", "GUILD_ROLE_UPDATE", "GUILD_ROLE_DELETE",
+        "CHANNEL_CREATE", "CHANNEL_UPDATE", "CHANNEL_DELETE", "CHANNEL_PINS_UPDATE",
+        "THREAD_CREATE", "THREAD_UPDATE", "THREAD_DELETE", "THREAD_LIST_SYNC",
+        "THREAD_MEMBER_UPDATE", "THREAD_MEMBERS_UPDATE", "STAGE_INSTANCE_CREATE",
+        "STAGE_INSTANCE_UPDATE", "STAGE_INSTANCE_DELETE")),
+    "GUILD_MEMBERS": (1 << 1, ("GUILD_MEMBER_ADD", "GUILD_MEMBER_UPDATE",
+        "GUILD_MEMBER_REMOVE", "THREAD_MEMBERS_UPDATE")),
+    "GUILD_MODERATION": (1 << 2, ("GUILD_AUDIT_LOG_ENTRY_CREATE", "GUILD_BAN_ADD",
+        "GUILD_BAN_REMOVE")),
+    "GUILD_EMOJIS_AND_STICKERS": (1 << 3, ("GUILD_EMOJIS_UPDATE", "GUILD_STICKERS_UPDATE")),
+    "GUILD_INTEGRATIONS": (1 << 4, ("GUILD_INTEGRATIONS_UPDATE", "INTEGRATION_CREATE",
+        "INTEGRATION_UPDATE", "INTEGRATION_DELETE")),
+    "GUILD_WEBHOOKS": (1 << 5, ("WEBHOOKS_UPDATE",)),
+    "GUILD_INVITES": (1 << 6, ("INVITE_CREATE", "INVITE_DELETE")),
+    "GUILD_VOICE_STATES": (1 << 7, ("VOICE_STATE_UPDATE",)),
+    "GUILD_PRESENCES": (1 << 8, ("PRESENCE_UPDATE",)),
+    "GUILD_MESSAGES": (1 << 9, ("MESSAGE_CREATE", "MESSAGE_UPDATE", "MESSAGE_DELETE",
+        "MESSAGE_DELETE_BULK")),
+    "GUILD_MESSAGE_REACTIONS": (1 << 10, ("MESSAGE_REACTION_ADD", "MESSAGE_REACTION_REMOVE",
+        "MESSAGE_REACTION_REMOVE_ALL", "MESSAGE_REACTION_REMOVE_EMOJI")),
+    "GUILD_MESSAGE_TYPING": (1 << 11, ("TYPING_START",)),
+    "DIRECT_MESSAGES": (1 << 12, ("MESSAGE_CREATE", "MESSAGE_UPDATE", "MESSAGE_DELETE",
+        "CHANNEL_PINS_UPDATE")),
+    "DIRECT_MESSAGE_REACTIONS": (1 << 13, ("MESSAGE_REACTION_ADD", "MESSAGE_REACTION_REMOVE",
+        "MESSAGE_REACTION_REMOVE_ALL", "MESSAGE_REACTION_REMOVE_EMOJI")),
+    "DIRECT_MESSAGE_TYPING": (1 << 14, ("TYPING_START",)),
+    # Not an event of its own, but needed to see the content of messages
+    "MESSAGE_CONTENT": (1 << 15, ("MESSAGE_CREATE", "MESSAGE_UPDATE")),
+    "GUILD_SCHEDULED_EVENTS": (1 << 16, ("GUILD_SCHEDULED_EVENT_CREATE",
+        "GUILD_SCHEDULED_EVENT_UPDATE", "GUILD_SCHEDULED_EVENT_DELETE",
+        "GUILD_SCHEDULED_EVENT_USER_ADD", "GUILD_SCHEDULED_EVENT_USER_REMOVE")),
+    "AUTO_MODERATION_CONFIGURATION": (1 << 20, ("AUTO_MODERATION_RULE_CREATE",
+        "AUTO_MODERATION_RULE_UPDATE", "AUTO_MODERATION_RULE_DELETE")),
+    "AUTO_MODERATION_EXECUTION": (1 << 21, ("AUTO_MODERATION_ACTION_EXECUTION",)),
+    }
+
+# Intents that must be enabled for the bot in Discord's developer portal
+# before we can ask for them, or Discord closes the connection with 4014.
+# MESSAGE_CONTENT is privileged too, but is asked for anyway, as plain
+# !commands can't work without it: it has to be enabled in the portal.
+PRIVILEGED_INTENTS = ("GUILD_MEMBERS", "GUILD_PRESENCES")
+
+# What process_event() wants the engine to do with a message
+DISPATCH = "DISPATCH"
+RECONNECT = "RECONNECT"
+
+# Websocket close codes after which Discord won't resume the session
+SESSION_CLOSE_CODES = (4007, 4009)
+
+# Websocket close codes that reconnecting won't fix, and what to fix instead
+FATAL_CLOSE_CODES = {
+    4004: "authentication failed, check BOT_TOKEN",
+    4010: "invalid shard, check SHARD_COUNT",
+    4011: "sharding required, set SHARD_COUNT",
+    4012: "invalid gateway API version",
+    4013: "invalid intents, check INTENTS",
+    4014: "disallowed intents, enable the privileged intents (including"
+        " MESSAGE_CONTENT) for the bot in Discord's developer portal",
+    }
+
+# How many recent dispatches to remember, to log what a replayed event was
+REPLAY_BUFFER_SIZE = 1000
+
+# Every complete zlib-stream payload ends with a zlib SYNC_FLUSH marker
+ZLIB_SUFFIX = b'\x00\x00\xff\xff'
+
+class ConnectionClosed(Exception):
+    """Raised by the engines when Discord closes the websocket."""
+    def __init__(self, code):
+        super(ConnectionClosed, self).__init__("websocket closed with code %s" % code)
+        self.code = code
+
+class FatalCloseError(Exception):
+    """Raised when Discord closes the websocket with a code that means
+    the bot can't connect until its configuration is fixed.
+    """
+    def __init__(self, code):
+        super(FatalCloseError, self).__init__("websocket closed with code %s: %s"
+            % (code, FATAL_CLOSE_CODES[code]))
+        self.code = code
+
+class Inflater(object):
+    """Turns raw websocket frames back into JSON payloads.
+    
+    With zlib-stream transport compression, the whole connection is a
+    single zlib stream, so there must be exactly one Inflater per
+    connection and every frame must go through it in order, starting
+    with the welcome packet. A payload can also span several websocket
+    frames, so feed() returns None until a full payload has arrived.
+    
+    Without compression, frames are passed straight through. Payloads
+    are returned as they arrived (bytes, or str for text frames) since
+    codec.loads() takes either.
+    """
+    def __init__(self, compress=None):
+        if compress is None:
+            compress = getattr(config, "GATEWAY_COMPRESS", False)
+        self.compress = compress
+        self._buffer = bytearray()
+        self._zlib = zlib.decompressobj() if compress else None
+    
+    def feed(self, data):
+        """Add a received frame, return the decoded payload if complete."""
+        if not self.compress:
+            return data
+        
+        self._buffer.extend(data)
+        if self._buffer[-4:] != ZLIB_SUFFIX:
+            return None
+        payload = self._zlib.decompress(bytes(self._buffer))
+        del self._buffer[:]
+        return payload
+
+def gateway_url(ws_url):
+    """Add the protocol version and compression query to a websocket URL."""
+    url = ws_url + config.GATEWAY_VERSION
+    if getattr(config, "GATEWAY_COMPRESS", False):
+        url += "&compress=zlib-stream"
+    return url
+
+def new_session(shard_id=0, shard_count=1):
+    """Return a fresh session state dict for the given shard."""
+    return {
+        "seq": 0,
+        "session_id": "",
+        # Where to resume this session, from READY
+        "resume_url": None,
+        "shard": [shard_id, shard_count],
+        # Event types of recent dispatches, keyed by sequence number
+        "recent": OrderedDict(),
+        # Sequence numbers of events we dropped ourselves (see
+        # event_dropped()), and the ones check_sequence() has picked up
+        "dropped": deque(),
+        "shed": set(),
+        # Connection state, reset by set_connected()
+        "connected": False,
+        "awaiting_ack": False,
+        "heartbeat_sent": 0,
+        "latency": None,
+        # Set while the engine has stopped reading, to let plugins catch up
+        "paused": False,
+        # Reconnect state, reset once we're logged in again
+        "disconnected_at": 0,
+        "reconnect_attempts": 0,
+        }
+
+def reset_session(session):
+    """Forget the session in-place, so the next login is a full identify.
+    
+    Reconnect state is kept, so backoff carries on where it left off.
+    """
+    disconnected_at = session["disconnected_at"]
+    attempts = session["reconnect_attempts"]
+    session.update(new_session(*session["shard"]))
+    session["disconnected_at"] = disconnected_at
+    session["reconnect_attempts"] = attempts
+
+def reconnect_delay(session):
+    """Return how many seconds to wait before reconnecting this session.
+    
+    Each call counts as a reconnection attempt. A resumable session gets
+    one immediate attempt, after that (or if we need a full identify)
+    the delay grows exponentially, with jitter so shards don't all
+    retry in lockstep. Sessions that have been disconnected for longer
+    than RESUME_WINDOW are reset, since Discord won't resume them
+    anyway. Identifies are also reserved with the identify limiter.
+    """
+    now = time.time()
+    if not session["disconnected_at"]:
+        session["disconnected_at"] = now
+    attempt = session["reconnect_attempts"]
+    session["reconnect_attempts"] += 1
+    
+    if session["session_id"] and now - session["disconnected_at"] > getattr(config, "RESUME_WINDOW", 120):
+        logging.info("Shard %s has been disconnected too long to resume", session["shard"][0])
+        reset_session(session)
+    
+    if session["session_id"] and attempt == 0:
+        return 0
+    delay = random.uniform(0, min(getattr(config, "RECONNECT_MAX_DELAY", BACKOFF_MAX), BACKOFF_BASE * 2 ** attempt))
+    if not session["session_id"]:
+        # Discord asks for 1-5 seconds between a failed resume and an
+        # identify, and the identify has to fit in the session limits
+        delay = max(delay, random.uniform(1, 5))
+        delay = identify_delay(session, now + delay)
+    return delay
+
+# Cached /gateway/bot response, and when it was fetched
+_GATEWAY_INFO = {}
+_GATEWAY_FETCHED = 0
+_GATEWAY_LOCK = threading.Lock()
+_GATEWAY_REFRESHING = threading.Event()
+
+def fetch_gateway_info():
+    """Ask Discord for the websocket URL, recommended shard count and
+    session start limits, and cache the answer.
+    """
+    global _GATEWAY_INFO, _GATEWAY_FETCHED
+    response = requests.get(config.BASE_URL + "/gateway/bot",
+        headers={"Authorization": "Bot " + config.BOT_TOKEN},
+        timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    info = codec.loads(response.content)
+    with _GATEWAY_LOCK:
+        _GATEWAY_INFO = info
+        _GATEWAY_FETCHED = time.time()
+    logging.debug("Gateway info: %s", info)
+    return info
+
+def _fetch_first_gateway_info():
+    """Fetch the gateway info we can't start without, retrying (with the
+    same backoff as reconnects) until Discord answers, so a network
+    that isn't up yet at boot, or a brief outage, doesn't stop the bot.
+    
+    Only a rejected token is worth giving up on.
+    """
+    attempt = 0
+    while True:
+        with _GATEWAY_LOCK:
+            info = _GATEWAY_INFO
+        if info:
+            # Another thread got there first
+            return info
+        try:
+            return fetch_gateway_info()
+        except Exception as err:
+            response = getattr(err, "response", None)
+            status = getattr(response, "status_code", None)
+            if status in (401, 403):
+                raise
+            delay = random.uniform(0, min(getattr(config, "RECONNECT_MAX_DELAY", BACKOFF_MAX),
+                BACKOFF_BASE * 2 ** attempt))
+            if status == 429:
+                delay = max(delay, float(response.headers.get("Retry-After") or 0))
+            attempt += 1
+            logging.warning("Failed to fetch gateway info: %s %s, retrying in %.1fs",
+                type(err), err, delay)
+            metrics.incr("gateway.info_failures")
+            time.sleep(delay)
+
+def _refresh_gateway_info():
+    """Refresh the cached gateway info, keeping the old copy on failure."""
+    try:
+        fetch_gateway_info()
+    except Exception as err:
+        logging.warning("Failed to refresh gateway info: %s %s", type(err), err)
+    finally:
+        _GATEWAY_REFRESHING.clear()
+
+def get_gateway_info():
+    """Return Discord's /gateway/bot response.
+    
+    Only the first call waits for Discord, for as long as it takes. After
+    that the cached copy is returned straight away, and refreshed in the
+    background once it's older than GATEWAY_INFO_TTL.
+    """
+    with _GATEWAY_LOCK:
+        info, fetched = _GATEWAY_INFO, _GATEWAY_FETCHED
+    if not info:
+        return _fetch_first_gateway_info()
+    ttl = getattr(config, "GATEWAY_INFO_TTL", GATEWAY_INFO_TTL)
+    if time.time() - fetched > ttl and not _GATEWAY_REFRESHING.is_set():
+        _GATEWAY_REFRESHING.set()
+        refresh = threading.Thread(target=_refresh_gateway_info)
+        refresh.daemon = True
+        refresh.start()
+    return info
+
+class IdentifyLimiter(object):
+    """Schedules identifies within Discord's session start limits.
+    
+    Shards are split (by shard ID) into max_concurrency rate limit
+    buckets, each of which can identify once every IDENTIFY_INTERVAL
+    seconds. On top of that, only so many sessions can be started a day,
+    and Discord may reset the bot's token if we start more. Once the
+    day's budget has run out, identifies wait until it resets. Only
+    identifies actually sent (see spend()) come out of the budget, so
+    connections that fail first, or end up resuming, cost nothing.
+    
+    With shared=True, the limiter's state is kept in shared memory, so
+    that the coordinator's worker processes can all use the same one.
+    """
+    # Indexes into _state, which is followed by the time each bucket's
+    # next identify is allowed
+    UPDATED, TOTAL, REMAINING, RESET_AT = range(4)
+    
+    def __init__(self, max_concurrency=1, shared=False):
+        self.max_concurrency = max(1, max_concurrency)
+        self.shared = shared
+        size = 4 + self.max_concurrency
+        if shared:
+            self._lock = multiprocessing.Lock()
+            self._state = multiprocessing.Array('d', size, lock=False)
+        else:
+            self._lock = threading.Lock()
+            self._state = [0.0] * size
+    
+    def update(self, limits, fetched):
+        """Take in the session_start_limit Discord gave us at `fetched`."""
+        with self._lock:
+            state = self._state
+            if fetched <= state[self.UPDATED]:
+                return
+            state[self.UPDATED] = fetched
+            state[self.TOTAL] = limits.get("total", 0)
+            state[self.REMAINING] = limits.get("remaining", 0)
+            state[self.RESET_AT] = fetched + limits.get("reset_after", 0) / 1000.0
+    
+    def _roll_over(self, when):
+        """Refill the budget if it will have been reset by `when`."""
+        state = self._state
+        while state[self.RESET_AT] and when >= state[self.RESET_AT]:
+            state[self.REMAINING] = state[self.TOTAL]
+            state[self.RESET_AT] += 24 * 60 * 60
+    
+    def reserve(self, shard_id, not_before=None):
+        """Schedule an identify for the given shard.
+        
+        The identify can't happen before `not_before` (a timestamp).
+        Returns how many seconds to wait before sending it.
+        """
+        now = time.time()
+        start = max(now, not_before or 0)
+        with self._lock:
+            state = self._state
+            if state[self.UPDATED]:
+                self._roll_over(start)
+                if state[self.REMAINING] < 1:
+                    logging.error("Out of session starts, shard %s can't identify for %.1f hours",
+                        shard_id, (state[self.RESET_AT] - now) / 3600)
+                    start = state[self.RESET_AT]
+            bucket = 4 + shard_id % self.max_concurrency
+            start = max(start, state[bucket])
+            state[bucket] = start + IDENTIFY_INTERVAL
+        
+        logging.info("Shard %s may identify in %.1fs", shard_id, start - now)
+        return start - now
+    
+    def spend(self):
+        """Count an identify that's being sent against the day's budget."""
+        now = time.time()
+        with self._lock:
+            state = self._state
+            if state[self.UPDATED]:
+                self._roll_over(now)
+                state[self.REMAINING] = max(0, state[self.REMAINING] - 1)
+            total, remaining, reset_at = state[self.TOTAL], state[self.REMAINING], state[self.RESET_AT]
+        
+        metrics.incr("gateway.identifies")
+        if not self.shared:
+            metrics.set_gauge("gateway.identify.remaining", int(remaining))
+        if total and remaining < total * IDENTIFY_LOW_BUDGET:
+            logging.warning("Only %d of %d session starts left, resetting in %.1f hours",
+                remaining, total, (reset_at - now) / 3600)
+    
+    def budget(self):
+        """Return (session starts left, daily total, time of the next reset)."""
+        with self._lock:
+            state = self._state
+            return int(state[self.REMAINING]), int(state[self.TOTAL]), state[self.RESET_AT]
+
+# The identify limiter for this process, see get_identify_limiter()
+LIMITER = None
+
+def get_identify_limiter():
+    """Return the identify limiter, brought up to date with Discord's limits."""
+    global LIMITER
+    info = get_gateway_info()
+    limits = info.get("session_start_limit") or {}
+    if LIMITER is None:
+        LIMITER = IdentifyLimiter(limits.get("max_concurrency", 1))
+    if limits:
+        LIMITER.update(limits, _GATEWAY_FETCHED)
+    return LIMITER
+
+def identify_delay(session, not_before=None):
+    """Schedule an identify for this session's shard, and return how many
+    seconds to wait before connecting to send it.
+    """
+    return get_identify_limiter().reserve(session["shard"][0], not_before)
+
+def get_shard_count():
+    """How many shards does the bot have in total?
+    
+    Uses SHARD_COUNT from config.py if it's set, otherwise the number
+    Discord recommends.
+    """
+    shard_count = getattr(config, "SHARD_COUNT", None)
+    if shard_count:
+        return shard_count
+    return get_gateway_info().get("shards", 1)
+
+def get_gateway_url():
+    """Return the websocket URL to connect new sessions to."""
+    return get_gateway_info()["url"]
+
+def connect_url(session):
+    """Return the full websocket URL this session should connect to.
+    
+    Resumes go to the session's own resume URL, if Discord gave us one.
+    """
+    if session["session_id"] and session["resume_url"]:
+        return gateway_url(session["resume_url"])
+    return gateway_url(get_gateway_url())
+
+def parse_hello(raw):
+    """Given the raw welcome packet, return the heartbeat interval in seconds."""
+    if not raw:
+        logging.error("No welcome message received from websocket")
+        raise RuntimeError("No welcome message received from websocket")
+    logging.debug("websocket recv: %s", raw)
+    # Round to nearest second
+    return int(codec.loads(raw)["d"]["heartbeat_interval"]) // 1000
+
+def intents_for(events):
+    """Return the intents bitmask needed to receive the given event types.
+    
+    If `events` is None, every unprivileged intent is returned. GUILDS is
+    always included, since Discord relies on it to tell us about our
+    guilds.
+    """
+    intents = INTENTS["GUILDS"][0]
+    for name, (bit, intent_events) in INTENTS.items():
+        if events is None:
+            if name not in PRIVILEGED_INTENTS:
+                intents |= bit
+        elif not events.isdisjoint(intent_events):
+            intents |= bit
+    return intents
+
+def get_intents():
+    """Return the intents to identify with.
+    
+    Uses INTENTS from config.py if it's set, otherwise works it out from
+    the events the loaded plugins need.
+    """
+    intents = getattr(config, "INTENTS", None)
+    if intents is None:
+        intents = intents_for(plugin_handler.wanted_events())
+    return intents
+
+def login_payload(session):
+    """Return the resume or identify payload appropriate for this session.
+    
+    An identify is counted against the day's session starts, so only
+    call this to send the payload.
+    """
+    if session.get("session_id"):
+        logging.info("Shard %s resuming session...", session["shard"][0])
+        return {
+            "op": 6,
+            "d": {
+                "token": config.BOT_TOKEN,
+                "session_id": session["session_id"],
+                "seq": session["seq"],
+            }}
+    else:
+        intents = get_intents()
+        get_identify_limiter().spend()
+        logging.info("Shard %s sending login with intents %s...", session["shard"][0], intents)
+        return {
+            "op": 2,
+            "d": {
+                "token": config.BOT_TOKEN,
+                "properties": {
+                    "os": "linux",
+                    "browser": "Disgordian",
+                    "device": "Disgordian",
+                },
+                "compress": False,
+                "large_threshold": 250,
+                "shard": session["shard"],
+                "intents": intents,
+            }}
+
+def heartbeat_payload(session):
+    """Return a heartbeat payload for this session."""
+    return {"op": 1, "d": session["seq"]}
+
+def heartbeat_sent(session):
+    """Record that a heartbeat was just sent, so we expect an ACK."""
+    session["awaiting_ack"] = True
+    session["heartbeat_sent"] = time.time()
+    metrics.incr("gateway.heartbeats")
+
+def is_zombie(session):
+    """Has the last heartbeat gone unacknowledged?
+    
+    Call this before sending each heartbeat. If Discord didn't ACK the
+    previous one within a whole heartbeat interval, the connection is
+    dead (even if the socket looks fine) and should be resumed. Unless
+    the engine has stopped reading for a while, in which case the ACK
+    is most likely there, just not read yet.
+    """
+    return session["awaiting_ack"] and not session["paused"]
+
+def event_dropped(session, content):
+    """Note that a dispatch was dropped before it got to check_sequence().
+    
+    Safe to call from any thread. The event won't be counted as missed.
+    """
+    seq = content.get("s")
+    if seq:
+        session["dropped"].append(int(seq))
+
+def _count_missed(session, first, last):
+    """Return how many of the events first..last we never received."""
+    dropped, shed = session["dropped"], session["shed"]
+    while dropped:
+        shed.add(dropped.popleft())
+    if not shed:
+        return last - first + 1
+    gap = range(first, last + 1)
+    missed = sum(1 for seq in gap if seq not in shed)
+    shed.difference_update(gap)
+    return missed
+
+def check_sequence(session, content):
+    """Check a dispatch's sequence number against what we've already seen.
+    
+    Returns False if the event is a duplicate (anything at or before the
+    last sequence number seen, e.g. replayed again after a resume),
+    otherwise records it and returns True. Gaps are counted, but still
+    let through. READY always starts the sequence afresh.
+    """
+    seq = content.get("s")
+    if not seq:
+        return True
+    seq = int(seq)
+    recent = session["recent"]
+    shard_id = session["shard"][0]
+    
+    # A new session starts a new sequence, whatever came before
+    if content.get("t") == "READY":
+        session["seq"] = 0
+        recent.clear()
+    
+    # Discord sends dispatches in order, so anything we've already gone
+    # past is a replay, whether or not it's still in the ring (which is
+    # only there to say what the original was)
+    if seq <= session["seq"]:
+        logging.debug("Shard %s dropping duplicate event %s (%s, first seen as %s)",
+            shard_id, seq, content.get("t"), recent.get(seq, "unknown"))
+        metrics.incr("gateway.seq.duplicates")
+        return False
+    if session["seq"] and seq > session["seq"] + 1:
+        missed = _count_missed(session, session["seq"] + 1, seq - 1)
+        if missed:
+            logging.warning("Shard %s missed %s events (%s to %s)",
+                shard_id, missed, session["seq"] + 1, seq - 1)
+            metrics.incr("gateway.seq.gaps")
+            metrics.incr("gateway.seq.missed", missed)
+    
+    recent[seq] = content.get("t")
+    while len(recent) > REPLAY_BUFFER_SIZE:
+        recent.popitem(last=False)
+    session["seq"] = seq
+    return True
+
+def process_event(session, content):
+    """Update session state from a received gateway message.
+    
+    Returns RECONNECT if the connection must be dropped and
+    re-established, DISPATCH if the message should be passed on to
+    plugins, or None if there's nothing more to do.
+    """
+    metrics.incr("gateway.events")
+    # If this is first message, set session_id
+    if content.get("t") == "READY":
+        session["session_id"] = content["d"].get("session_id")
+        session["resume_url"] = content["d"].get("resume_gateway_url")
+    # Successfully logged in, so stop backing off
+    if content.get("t") in ("READY", "RESUMED"):
+        session["disconnected_at"] = 0
+        session["reconnect_attempts"] = 0
+    # Update heartbeat number, skipping anything we've already handled
+    if content["op"] == 0 and not check_sequence(session, content):
+        return None
+    
+    # Heartbeat ACK, note the round-trip time
+    if content["op"] == 11:
+        session["awaiting_ack"] = False
+        session["latency"] = time.time() - session["heartbeat_sent"]
+        metrics.set_gauge("gateway.shard.%s.latency_ms" % session["shard"][0],
+            int(session["latency"] * 1000))
+    
+    # Discord wants us to reconnect and resume
+    if content["op"] == 7:
+        logging.info("Shard %s asked to reconnect", session["shard"][0])
+        return RECONNECT
+    
+    # Rejected login or rejected heartbeat - disconnect and try again
+    if content["op"] == 9:
+        # Session resumption failed, unless Discord says it's resumable
+        if not content.get("d"):
+            reset_session(session)
+        return RECONNECT
+    
+    if wants_dispatch(content):
+        return DISPATCH
+    return None
+
+def connection_closed(session, code):
+    """Update session state after Discord closed the websocket with the
+    given close code (None if we don't know it).
+    
+    Raises FatalCloseError if reconnecting won't help.
+    """
+    if code is None:
+        return
+    metrics.incr("gateway.closed.%s" % code)
+    if code in FATAL_CLOSE_CODES:
+        raise FatalCloseError(code)
+    if code in SESSION_CLOSE_CODES:
+        logging.info("Shard %s session can't be resumed (close code %s), identifying again",
+            session["shard"][0], code)
+        reset_session(session)
+
+def set_connected(session, connected):
+    """Record whether this session's shard is currently connected."""
+    session["connected"] = connected
+    session["awaiting_ack"] = False
+    session["paused"] = False
+    if not connected and not session["disconnected_at"]:
+        session["disconnected_at"] = time.time()
+    metrics.set_gauge("gateway.shard.%s.connected" % session["shard"][0], int(connected))
+    if connected:
+        metrics.incr("gateway.connects")
+
+def wants_dispatch(content):
+    """Should this message be passed to plugins?
+    
+    Don't pass messages we've generated as this could lead to infinite
+    looping.
+    """
+    return content["op"] == 0 and (content["d"] or {}).get("author", {}).get("id") != config.SELF
@@ -6,10 +6,10 @@ from __future__ import division, print_function
 
 import argparse
 from collections import namedtuple
-import json
 import logging
 import logging.config
 import signal
+import struct
 import sys
 import threading
 import time
@@ -17,7 +17,12 @@ import time
 import requests
 import websocket
 
+import capture
+import codec
 import config
+import gateway
+import metrics
+import msgqueue
 import plugin_handler
 
 # py2/3 compat
@@ -28,33 +33,59 @@ else:
     import queue
 
 
+# How often (in seconds) to check whether the plugins have caught up,
+# while they're too backed up to take more events
+BACKLOG_POLL = 0.05
+
 # Global event queue, handled by main() loop
-MSGQUEUE = queue.Queue()
+# Every item is a tuple of (message type, shard ID, [content]). For
+# WEBSOCKET_ERROR, the content is the websocket that failed, followed by
+# Discord's close code if it closed the websocket.
+# Dispatches (op 0) from Discord are "MSG" events; every other gateway
+# op is a "GATEWAY" control message (both followed by the websocket they
+# arrived on, so anything left over from a replaced one is ignored), so a heartbeat ACK or a reconnect
+# request is never stuck behind a backlog of events. Control messages
+# are always handled before any waiting "MSG" events, and "MSG" events
+# are shed (or the reader blocked) once too many are waiting - see
+# msgqueue.py.
+MSGQUEUE = msgqueue.MessageQueue(
+    max_events=getattr(config, "QUEUE_MAX_EVENTS", 10000),
+    policy=getattr(config, "QUEUE_OVERLOAD_POLICY", "drop"),
+    shed_events=getattr(config, "QUEUE_SHED_EVENTS", msgqueue.SHED_EVENTS))
 
 # Handle signals gracefully
 def sig_handler(signum, frame):
-    MSGQUEUE.put("QUIT")
+    MSGQUEUE.put(("QUIT", None))
 signal.signal(signal.SIGINT, sig_handler)
 
-def clean_queue(msgqueue):
+# Reload changed plugins on SIGHUP
+def reload_handler(signum, frame):
+    MSGQUEUE.put(("RELOAD", None))
+if hasattr(signal, "SIGHUP"):
+    signal.signal(signal.SIGHUP, reload_handler)
+
+def clean_queue(msgqueue, shard_id):
     """Perform an in-place modification of the given queue, removing
-    any message types we don't want in there.
+    any message types we don't want in there for the given shard.
     
-    Used to remove heartbeat and reconnection requests if we're already
-    in a failure mode.
+    Used to remove heartbeat and reconnection requests, and anything
+    left over from the old connection, if we're already in a failure
+    mode. Only control messages are affected, so this is
+    cheap however many events are waiting.
     """
-    badtypes = ("WEBSOCKET_ERROR", "WEBSOCKET_CONNECT", "HEARTBEAT")
-    msgs = []
-    while True:
-        try:
-            msgs.append(msgqueue.get(False))
-        except queue.Empty:
-            break
-    for msg in msgs:
-        if msg not in badtypes:
-            msgqueue.put(msg)
+    badtypes = ("WEBSOCKET_ERROR", "WEBSOCKET_CONNECT", "HEARTBEAT", "GATEWAY")
+    msgqueue.remove_control(lambda msg: msg[0] in badtypes and msg[1] == shard_id)
 
-def heartbeater(myqueue):
+def put_later(delay, msg):
+    """Put `msg` on MSGQUEUE after `delay` seconds, without blocking."""
+    if delay <= 0:
+        MSGQUEUE.put(msg)
+        return
+    timer = threading.Timer(delay, MSGQUEUE.put, args=[msg])
+    timer.setDaemon(True)
+    timer.start()
+
+def heartbeater(myqueue, shard_id):
     """Loop forever, sending heartbeats. `interval` is in seconds.
     
     If the heartbeat interval needs to be updated (i.e. for a websocket
@@ -73,43 +104,69 @@ def heartbeater(myqueue):
         except queue.Empty:
             pass
         time.sleep(interval)
-        MSGQUEUE.put("HEARTBEAT")
+        MSGQUEUE.put(("HEARTBEAT", shard_id))
+
+def receive(sock):
+    """Return the next text or binary frame from the websocket.
+    
+    Raises gateway.ConnectionClosed if Discord closes the websocket.
+    """
+    opcode, data = sock.recv_data()
+    if opcode == websocket.ABNF.OPCODE_CLOSE:
+        code = struct.unpack("!H", data[:2])[0] if len(data) >= 2 else None
+        raise gateway.ConnectionClosed(code)
+    return data
 
-def readloop(sock):
-    """Loop over the websocket, waiting for input."""
+def readloop(sock, inflater, shard_id):
+    """Loop over the websocket, waiting for input.
+    
+    `inflater` must be the gateway.Inflater this connection was opened
+    with.
+    """
     try:
         while True:
             # Wait for incoming message
-            incoming = sock.recv()
+            incoming = inflater.feed(receive(sock))
+            if incoming is None:
+                # Only part of a compressed payload, wait for the rest
+                continue
             logging.debug("websocket recv: %s", incoming)
-            msg = json.loads(incoming)
-            MSGQUEUE.put(("MSG", msg))
+            capture.record(shard_id, incoming)
+            msg = codec.loads(incoming)
+            MSGQUEUE.put(("MSG" if msg.get("op") == 0 else "GATEWAY", shard_id, msg, sock))
+    except gateway.ConnectionClosed as err:
+        logging.warning("Shard %s %s", shard_id, err)
+        MSGQUEUE.put(("WEBSOCKET_ERROR", shard_id, sock, err.code))
     except Exception as err:
-        logging.error("readloop died: %s %s", type(err), err)
-        MSGQUEUE.put("WEBSOCKET_ERROR")
+        logging.error("Shard %s readloop died: %s %s", shard_id, type(err), err)
+        MSGQUEUE.put(("WEBSOCKET_ERROR", shard_id, sock))
 
 _SOCK_LOCK = threading.RLock()
 def socket_send(sock, msg):
     """Thread-safe handling of socket sends.
     
-    `msg` can be a string or a dictionary, but must represent a
+    `msg` can be a string, bytes or a dictionary, but must represent a
     complete Discord API message.
     """
     logging.debug("websocket send: %s", msg)
-    if not isinstance(msg, str):
-        msg = json.dumps(msg)
+    if isinstance(msg, dict):
+        msg = codec.dumpb(msg)
     with _SOCK_LOCK:
         sock.send(msg)
 
 def websocket_connect(session):
-    """Connect to the websocket, login."""
-    # Get the websocket URL from discord
-    ws_url = requests.get(config.BASE_URL + "/gateway").json()['url']
+    """Connect to the websocket, login.
+    
+    Returns the websocket, the heartbeat interval, and the
+    gateway.Inflater that must decode everything read from it.
+    """
+    # Get the websocket URL, cached from Discord
+    ws_url = gateway.connect_url(session)
     
     # Connect to server
-    logging.info("Connecting to websocket server at %s ...", ws_url + config.GATEWAY_VERSION)
+    logging.info("Connecting to websocket server at %s ...", ws_url)
     wsock = websocket.create_connection(
-        ws_url + config.GATEWAY_VERSION,
+        ws_url,
         timeout=config.WS_TIMEOUT,
         origin="https://discord.com",
         sslopt={'ca_certs':requests.utils.DEFAULT_CA_BUNDLE_PATH},
@@ -117,159 +174,229 @@ def websocket_connect(session):
     logging.debug("Connected")
     
     # Get welcome packet, stash heartbeat interval
-    temp = wsock.recv()
-    if not temp:
-        logging.error("No welcome message received from websocket")
-        raise RuntimeError("No welcome message received from websocket")
-    logging.debug("websocket recv: %s", temp)
-    hbi = int(json.loads(temp)["d"]["heartbeat_interval"]) // 1000  # Round to nearest second
+    inflater = gateway.Inflater()
+    hello = None
+    while hello is None:
+        hello = inflater.feed(receive(wsock))
+    hbi = gateway.parse_hello(hello)
     
     # Set timeout so the websocket won't hang indefinitely
     wsock.settimeout(2*hbi)
     
     # Login
-    if session.get("session_id"):
-        logging.info("Resuming session...")
-        socket_send(wsock, {
-            "op": 6,
-            "d": {
-                "token": config.BOT_TOKEN,
-                "session_id": session["session_id"],
-                "seq": session["seq"],
-            }})
-    else:
-        logging.info("Sending login...")
-        socket_send(wsock, {
-            "op": 2,
-            "d": {
-                "token": config.BOT_TOKEN,
-                "properties": {
-                    "$os": "linux",
-                    "$browser": "Disgordian",
-                    "$device": "Disgordian",
-                    "$referrer": "",
-                    "$referring_domain": ""
-                },
-                "compress": False,
-                "large_threshold": 250,
-                "shard": [0, 1]
-            }})
-    return wsock, hbi
+    socket_send(wsock, gateway.login_payload(session))
+    return wsock, hbi, inflater
+
+class Shard(object):
+    """One gateway connection, with its own session, sequence number and
+    heartbeat thread.
+    """
+    def __init__(self, shard_id, shard_count):
+        self.shard_id = shard_id
+        self.session = gateway.new_session(shard_id, shard_count)
+        
+        # Add a placeholder websocket object with a close() method, so
+        # WEBSOCKET_ERROR doesn't crash if our first connection fails
+        self.wsock = self.placeholder()
+        
+        # Start heartbeat loop
+        self.hb_queue = queue.Queue()
+        hb_thread = threading.Thread(target=heartbeater, args=[self.hb_queue, shard_id])
+        hb_thread.setDaemon(True)
+        hb_thread.start()
+    
+    @staticmethod
+    def placeholder():
+        """Return a stand-in for a websocket that isn't connected."""
+        return namedtuple("WebSocket", "close")(close=lambda: None)
+    
+    def close(self):
+        """Close the websocket, ignoring any errors.
+        
+        The websocket is replaced by a placeholder, so any errors the old
+        one raises from now on can be recognised as stale.
+        """
+        gateway.set_connected(self.session, False)
+        try:
+            self.wsock.close()
+        except:
+            pass
+        self.wsock = self.placeholder()
 
-def main():
-    """Replacement for main() """
-    # Create queue and prepare to connect
-    MSGQUEUE.put("WEBSOCKET_CONNECT")
+def main(shard_ids=None, shard_count=None):
+    """Run the given shards (by default, all of them) until told to quit.
+    
+    Every shard shares this one loop, so events from all of them are
+    dispatched to plugins from the same place.
+    """
+    if shard_count is None:
+        shard_count = gateway.get_shard_count()
+    if shard_ids is None:
+        shard_ids = range(shard_count)
     
     # Initialise plugins from the "plugins" directory
     plugin_handler.load("plugins")
     
-    # Initialise sequence number to zero.
-    session = {"seq": 0, "session_id": ""}
+    # Create shards and prepare to connect, spacing the identifies out
+    # within Discord's limits
+    shards = {}
+    # Set if Discord refuses to let us connect at all
+    fatal = None
+    for shard_id in shard_ids:
+        shards[shard_id] = Shard(shard_id, shard_count)
+        delay = gateway.identify_delay(shards[shard_id].session)
+        put_later(delay, ("WEBSOCKET_CONNECT", shard_id))
     
-    # Add a placeholder websocket object with a close() method, so
-    # WEBSOCKET_ERROR doesn't crash if our first connection fails
-    wsock = namedtuple("WebSocket", "close")(close=lambda: None)
-    
-    # Start heartbeat loop
-    hb_queue = queue.Queue()
-    hb_thread = threading.Thread(target=heartbeater, args=[hb_queue])
-    hb_thread.setDaemon(True)
-    hb_thread.start()
+    # Events shed by the queue aren't sequence gaps
+    def event_dropped(msg):
+        shard = shards.get(msg[1])
+        if shard:
+            gateway.event_dropped(shard.session, msg[2])
+    MSGQUEUE.on_drop = event_dropped
     
     # Wait for messages in queue
     while True:
+        # While the plugins are backed up, leave events waiting in the
+        # queue (where its overload policy applies), but keep up with
+        # heartbeats and reconnects
+        events = plugin_handler.has_room()
         try:
             # We need a timeout on this queue so that signals can
             # interrupt the get() call. The read thread will timeout
             # after 2*hb_int of inactivity, so we don't expect to
             # reach this
-            msg = MSGQUEUE.get(True, 9999)
+            msg = MSGQUEUE.get(True, 9999 if events else BACKLOG_POLL, events=events)
         except queue.Empty:
+            if not events:
+                continue
             # Expect to never reach here
-            msg = "QUEUE_EMPTY"
+            msg = ("QUEUE_EMPTY", None)
         
-        if msg[0] == "MSG":
-            content = msg[1]
-            # Fork off to process
-            # If this is first message, set session_id
-            if content.get("t") == "READY":
-                session["session_id"] = content["d"].get("session_id")
-            # Update heartbeat number
-            # TODO: Get upset if we receive messages out of order
-            if content.get("s"):
-                session["seq"] = int(content.get("s"))
-            
+        kind = msg[0]
+        shard = shards.get(msg[1])
+        
+        if kind in ("MSG", "GATEWAY"):
+            # Ignore whatever was still queued from websockets we've
+            # already replaced: it belongs to a session that's over
+            if len(msg) > 3 and msg[3] is not shard.wsock:
+                continue
+            content = msg[2]
+            action = gateway.process_event(shard.session, content)
             # Rejected login or rejected heartbeat - disconnect and try again
-            if content["op"] == 9:
-                # Session resumption failed
-                session = {"seq": 0, "session_id": ""}
-                MSGQUEUE.put("WEBSOCKET_ERROR")
+            if action == gateway.RECONNECT:
+                MSGQUEUE.put(("WEBSOCKET_ERROR", shard.shard_id, shard.wsock))
             
             # Pass to plugins
-            # Don't pass messages we've generated as this could lead to
-            # infinite looping
-            if content["op"] == 0 and (content["d"] or {}).get("author", {}).get("id") != config.SELF:
+            elif action == gateway.DISPATCH:
                 plugin_handler.handle(content)
         
-        elif msg == "HEARTBEAT":
-            # Send heartbeat
+        elif kind == "HEARTBEAT":
             # We don't care about dropping heartbeats if the socket is down
+            if not shard.session["connected"]:
+                continue
+            
+            # If the last heartbeat was never acknowledged, the connection
+            # is a zombie. Resume straight away rather than waiting for
+            # the socket to time out
+            if gateway.is_zombie(shard.session):
+                logging.warn("Shard %s missed a heartbeat ACK", shard.shard_id)
+                metrics.incr("gateway.zombies")
+                MSGQUEUE.put(("WEBSOCKET_ERROR", shard.shard_id, shard.wsock))
+                continue
+            
+            # Send heartbeat
             try:
-                socket_send(wsock, {"op": 1, "d": session["seq"]})
+                socket_send(shard.wsock, gateway.heartbeat_payload(shard.session))
+                gateway.heartbeat_sent(shard.session)
             except Exception as err:
-                logging.info("Failed to send heartbeat: %s %s", type(err), err)
-                MSGQUEUE.put("WEBSOCKET_ERROR")
+                logging.info("Shard %s failed to send heartbeat: %s %s", shard.shard_id, type(err), err)
+                MSGQUEUE.put(("WEBSOCKET_ERROR", shard.shard_id, shard.wsock))
         
-        elif msg == "QUIT":
+        elif kind == "QUIT":
             # Shutdown
             logging.info("Main loop stopping...")
             break
         
-        elif msg == "WEBSOCKET_ERROR":
+        elif kind == "RELOAD":
+            # Reload in the background, the old plugins carry on until
+            # the new ones are ready
+            reload_thread = threading.Thread(target=plugin_handler.reload)
+            reload_thread.setDaemon(True)
+            reload_thread.start()
+        
+        elif kind == "WEBSOCKET_ERROR":
+            # Ignore errors from websockets we've already replaced
+            if msg[2] is not shard.wsock:
+                continue
+            
+            # Some close codes mean the session can't be resumed, or
+            # that there's no point reconnecting at all
+            if len(msg) > 3:
+                try:
+                    gateway.connection_closed(shard.session, msg[3])
+                except gateway.FatalCloseError as err:
+                    logging.error("Shard %s %s, stopping", shard.shard_id, err)
+                    fatal = err
+                    break
+            
             # Kill the existing websocket
-            delay = 6
-            logging.warn("Websocket appears to have died. Reconnecting in %ss...", delay)
+            delay = gateway.reconnect_delay(shard.session)
+            logging.warn("Shard %s websocket appears to have died. Reconnecting in %.1fs...", shard.shard_id, delay)
+            metrics.incr("gateway.reconnects")
             # Make sure the old socket is closed first
-            try:
-                wsock.close()
-            except:
-                pass
-            # Wait a little, then reconnect
-            time.sleep(delay)
-            clean_queue(MSGQUEUE)
-            MSGQUEUE.put("WEBSOCKET_CONNECT")
+            shard.close()
+            # Schedule the reconnect, rather than sleeping here and
+            # holding up every other shard
+            clean_queue(MSGQUEUE, shard.shard_id)
+            put_later(delay, ("WEBSOCKET_CONNECT", shard.shard_id))
         
-        elif msg == "WEBSOCKET_CONNECT":
+        elif kind == "WEBSOCKET_CONNECT":
+            # Ignore stale reconnect requests
+            if shard.session["connected"]:
+                continue
+            
             # Purge any heartbeats, connects, or error messages from the
             # queue so we don't double-process
-            clean_queue(MSGQUEUE)
+            clean_queue(MSGQUEUE, shard.shard_id)
             
             # Reconnect to websocket
             try:
-                wsock, hb_int = websocket_connect(session)
+                shard.wsock, hb_int, inflater = websocket_connect(shard.session)
             except:
                 # Failure!
-                MSGQUEUE.put("WEBSOCKET_ERROR")
-                logging.warn("Reconnection failed!")
+                MSGQUEUE.put(("WEBSOCKET_ERROR", shard.shard_id, shard.wsock))
+                logging.warn("Shard %s reconnection failed!", shard.shard_id)
                 continue
+            gateway.set_connected(shard.session, True)
             # Update heartbeat interval
-            hb_queue.put(hb_int)
+            shard.hb_queue.put(hb_int)
             # Start new thread for receiving from socket
-            recv_thread = threading.Thread(target=readloop, args=[wsock])
+            recv_thread = threading.Thread(target=readloop, args=[shard.wsock, inflater, shard.shard_id])
             recv_thread.setDaemon(True)
             recv_thread.start()
         else:
             logging.error("Unknown message type: %s", msg)
             break
     
-    # Explicitly close socket when this function stops
-    wsock.close()
+    # Explicitly close sockets when this function stops
+    for shard in shards.values():
+        shard.close()
+    if fatal:
+        raise fatal
 
 def parse_args():
     """Create and run argparse"""
     parser = argparse.ArgumentParser(description="Discord bot")
     parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("--engine", choices=("thread", "asyncio"),
+        default=getattr(config, "ENGINE", "thread"),
+        help="Connection engine to run the gateway on")
+    parser.add_argument("--processes", type=int,
+        default=getattr(config, "SHARD_PROCESSES", 1),
+        help="Split the shards across this many worker processes")
+    parser.add_argument("--record", metavar="FILE",
+        default=getattr(config, "RECORD_FILE", None),
+        help="Record gateway traffic to this capture file")
     return parser.parse_args()
 
 if __name__ == '__main__':
@@ -286,7 +413,19 @@ if __name__ == '__main__':
         raise RuntimeError("You haven't provided a valid Discord bot token, please edit config.py")
     
     try:
-        main()
+        if ARGS.processes > 1:
+            import coordinator
+            coordinator.run(ARGS.processes, ARGS.engine, record=ARGS.record)
+        else:
+            if ARGS.record:
+                capture.start(ARGS.record)
+            if ARGS.engine == "asyncio":
+                import async_engine
+                async_engine.main()
+            else:
+                main()
     except Exception as err:
         logging.error("Main thread crashed: %s %s", repr(err), err)
         raise
+    finally:
+        capture.stop()
@@ -0,0 +1,40 @@
+"""
+Process-wide counters and gauges.
+
+Counters only ever go up (events received, reconnects...), gauges are
+set to whatever the current value is (connected shards, queue depth...).
+Both are keyed by a dotted name, e.g. "gateway.events".
+
+snapshot() returns a copy that's safe to log or send to another process,
+and merge() combines snapshots from several processes.
+"""
+
+import threading
+
+_LOCK = threading.Lock()
+COUNTERS = {}
+GAUGES = {}
+
+def incr(name, amount=1):
+    """Increase a counter."""
+    with _LOCK:
+        COUNTERS[name] = COUNTERS.get(name, 0) + amount
+
+def set_gauge(name, value):
+    """Set a gauge to its current value."""
+    with _LOCK:
+        GAUGES[name] = value
+
+def snapshot():
+    """Return a copy of all counters and gauges."""
+    with _LOCK:
+        return {"counters": dict(COUNTERS), "gauges": dict(GAUGES)}
+
+def merge(snapshots):
+    """Combine several snapshots into one, summing values with the same name."""
+    result = {"counters": {}, "gauges": {}}
+    for snap in snapshots:
+        for kind in ("counters", "gauges"):
+            for name, value in snap.get(kind, {}).items():
+                result[kind][name] = result[kind].get(name, 0) + value
+    return result
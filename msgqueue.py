@@ -0,0 +1,221 @@
+"""
+The main loop's message queue.
+
+Gateway events and control messages (heartbeats, reconnects, quit) go
+through the same queue, but in separate lanes: get() always returns a
+waiting control message before any event, so a flood of events (say,
+after a resume) can't delay a heartbeat long enough for Discord to drop
+us. Stale control messages can also be removed without touching, or
+reordering, the event lane.
+
+The event lane can be bounded. When it's full, the overload policy
+decides what happens to a new event:
+ * "drop": shed low-value events (presence updates and typing, by
+   default) first - either the new event, or the oldest waiting one -
+   and only drop anything else if there's nothing left to shed.
+ * "coalesce": as for "drop", but first try to replace a waiting event
+   that the new one supersedes (e.g. an older presence update for the
+   same user).
+ * "block": make the reader wait until there's room, pushing back on
+   the websocket instead of losing anything.
+Only dispatches (op 0) other than READY and RESUMED are ever dropped or
+coalesced. Anything else that reaches the event lane is let in even when
+it's full, as losing it would break the session rather than just miss
+an update. Every dropped or coalesced event is counted in metrics.
+
+Has the same put()/get() interface as queue.Queue, and raises
+queue.Empty the same way.
+"""
+
+from collections import deque
+import sys
+import threading
+import time
+
+import metrics
+
+# py2/3 compat
+if sys.version_info[0] == 2:
+    import Queue as queue
+else:
+    import queue
+
+POLICIES = ("drop", "coalesce", "block")
+
+# Events shed first when the queue is full
+SHED_EVENTS = ("PRESENCE_UPDATE", "TYPING_START")
+
+# Dispatches that are never dropped or coalesced, whatever the policy
+PROTECTED_EVENTS = ("READY", "RESUMED")
+
+def event_type(msg):
+    """Return the Discord event type of a ("MSG", shard ID, content) message."""
+    return msg[2].get("t")
+
+def sheddable(msg):
+    """Can this event be dropped or coalesced when the queue is full?"""
+    return msg[2].get("op") == 0 and event_type(msg) not in PROTECTED_EVENTS
+
+def coalesce_key(msg):
+    """Return a key shared by events that supersede each other, or None."""
+    if not sheddable(msg):
+        return None
+    kind = event_type(msg)
+    data = msg[2].get("d") or {}
+    if kind in ("PRESENCE_UPDATE", "GUILD_MEMBER_UPDATE"):
+        return (kind, data.get("guild_id"), (data.get("user") or {}).get("id"))
+    elif kind == "TYPING_START":
+        return (kind, data.get("channel_id"), data.get("user_id"))
+    return None
+
+class MessageQueue(object):
+    """Two-lane queue of (message type, ...) tuples.
+    
+    Messages whose type is in `event_types` go in the event lane,
+    everything else is a control message. At most `max_events` events
+    are held at once (0 means no limit), with `policy` deciding what
+    happens beyond that. `on_drop`, if set, is called with every event
+    that gets dropped or coalesced away.
+    """
+    def __init__(self, event_types=("MSG",), max_events=0, policy="drop",
+            shed_events=SHED_EVENTS, on_drop=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown queue overload policy %s" % policy)
+        self.event_types = event_types
+        self.max_events = max_events
+        self.policy = policy
+        self.shed_events = frozenset(shed_events)
+        self.on_drop = on_drop
+        self.control = deque()
+        # Events are kept in one-item lists ("boxes"), so one can be
+        # dropped from the middle of the lane by emptying its box
+        self.events = deque()
+        self.depth = 0
+        # Boxes of sheddable events, oldest first
+        self._shed_boxes = deque()
+        # Coalesce key -> box of the latest event with that key
+        self._coalesce = {}
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+    
+    def put(self, msg):
+        """Add a message to the appropriate lane."""
+        with self._lock:
+            if msg[0] not in self.event_types:
+                self.control.append(msg)
+                self._cond.notify()
+                return
+            
+            if self.max_events and self.depth >= self.max_events and sheddable(msg):
+                if self.policy == "block":
+                    while self.depth >= self.max_events:
+                        self._not_full.wait()
+                elif not self._make_room(msg):
+                    self._shed(msg, "dropped")
+                    return
+            
+            box = [msg]
+            self.events.append(box)
+            self.depth += 1
+            if event_type(msg) in self.shed_events and sheddable(msg):
+                self._shed_boxes.append(box)
+            if self.policy == "coalesce":
+                key = coalesce_key(msg)
+                if key:
+                    self._coalesce[key] = box
+            self._cond.notify()
+    
+    def _make_room(self, msg):
+        """Try to free a space in the full event lane for `msg`.
+        
+        Returns False if `msg` itself should be dropped instead.
+        """
+        if self.policy == "coalesce":
+            old = self._coalesce.get(coalesce_key(msg))
+            if old and old[0] is not None:
+                self._shed(old[0], "coalesced")
+                self._discard(old)
+                return True
+        
+        # Low-value events go first, starting with the one we were given
+        if event_type(msg) in self.shed_events:
+            return False
+        while self._shed_boxes:
+            box = self._shed_boxes.popleft()
+            if box[0] is not None:
+                self._shed(box[0], "dropped")
+                self._discard(box)
+                return True
+        return False
+    
+    def _discard(self, box):
+        """Empty a box, removing its event from the lane."""
+        box[0] = None
+        self.depth -= 1
+    
+    def _shed(self, msg, reason):
+        """Count an event we're not going to deliver."""
+        metrics.incr("queue.%s" % reason)
+        metrics.incr("queue.%s.%s" % (reason, event_type(msg)))
+        if self.on_drop:
+            self.on_drop(msg)
+    
+    def _pop_event(self):
+        """Remove and return the oldest event, or None if there isn't one."""
+        while self.events:
+            box = self.events.popleft()
+            if self._shed_boxes and self._shed_boxes[0] is box:
+                self._shed_boxes.popleft()
+            msg = box[0]
+            if msg is None:
+                # Dropped or coalesced
+                continue
+            self._discard(box)
+            if self._coalesce:
+                key = coalesce_key(msg)
+                if self._coalesce.get(key) is box:
+                    del self._coalesce[key]
+            self._not_full.notify()
+            return msg
+        return None
+    
+    def get(self, block=True, timeout=None, events=True):
+        """Remove and return the next message, control messages first.
+        
+        With events=False, only control messages are returned, and the
+        events are left waiting (and subject to the overload policy).
+        """
+        with self._lock:
+            if block and timeout is not None:
+                deadline = time.time() + timeout
+            while not self.control and not (events and self.depth):
+                if not block:
+                    raise queue.Empty
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self._cond.wait(remaining)
+            if self.control:
+                return self.control.popleft()
+            msg = self._pop_event()
+            metrics.set_gauge("queue.depth", self.depth)
+            return msg
+    
+    def remove_control(self, predicate):
+        """Remove every control message for which predicate(msg) is true.
+        
+        The event lane is left untouched.
+        """
+        with self._lock:
+            keep = [msg for msg in self.control if not predicate(msg)]
+            self.control.clear()
+            self.control.extend(keep)
+    
+    def qsize(self):
+        """Return the total number of messages waiting."""
+        with self._lock:
+            return len(self.control) + self.depth
@@ -6,28 +6,49 @@ A `COMMANDS` dictionary, mapping command keywords to callables.
 
 All of these callables must take a single positional argument - a dict
 representing a JSON message received from the Discord websocket API.
+Commands are given it as a bot_utils.CommandContext, with the command
+and its arguments already parsed.
 
 The COMMANDS dictionary will create simple !command-style handlers.
 The handle() function will be called for every event received from Discord.
+
+Handlers registered with bot_utils.handler() can list the event types
+they need, which decides which gateway intents the bot asks for. They
+are then only called for those event types, and only for one event per
+channel at a time, so commands in a channel run in the order they were
+sent.
 """
 
-import imp
+from collections import deque
+from functools import partial
+import json
 import logging
 import os
 import re
+import sys
 import threading
+import time
+
+# py2/3 compat
+try:
+    from concurrent import futures
+    import importlib.util as importlib_util
+    import tracemalloc
+except ImportError:
+    import imp
+    importlib_util = None
+    tracemalloc = None
 
 import bot_utils
 import config
+import metrics
+import ratelimit
+import workerpool
 
 
-@bot_utils.handler
+@bot_utils.handler("MESSAGE_CREATE")
 def do_command(msg):
     """Check if we need to call a keyword-style command."""
-    # If this isn't a spoken chat message, ignore it
-    if msg.get("t") != "MESSAGE_CREATE":
-        return
-    
     # If the message doesn't begin with our command char, ignore it
     content = msg.get("d").get("content")
     if not content.startswith(config.COMMAND_CHAR):
@@ -37,70 +58,811 @@ def do_command(msg):
     if msg["d"]["author"].get("bot") and not config.BOT_COMMANDS:
         return
     
-    # Remove the command prefix from the message
+    # Remove the command prefix from the message, and split off any args
     content = content[len(config.COMMAND_CHAR):]
-    
-    # Do we have args for this command?
+    text = ""
     if ' ' in content:
-        content = content.split(' ', 1)[0]
+        content, text = content.split(' ', 1)
     
     # Normalise case
     content = content.lower()
     
-    # Check whether a dynamic content handler will take this
-    handled = False
-    for regex in bot_utils.RECOMMANDS:
-        if (re.match(regex, content)):
-            handled = True
-    
     # Ignore a lone command character
     if not content:
-        pass
+        return
+    
+    # Ignore anyone flooding us, before spending a reply on them
+    if rate_limited(msg, content):
+        return
+    
     # Is the command recognised? If so, call it
-    elif content in bot_utils.COMMANDS:
-        bot_utils.COMMANDS[content](msg)
-    elif not handled:
+    found = get_matcher().match(content)
+    if found is None:
         bot_utils.reply(msg, "Unknown command: _{0}{1}_.".format(config.COMMAND_CHAR, content))
+        return
+    func, match = found
+    if func is None:
+        # Matched a bare RECOMMANDS regex, someone else handles it
+        return
+    if plugin_name(func) in DISABLED:
+        bot_utils.reply(msg, "Sorry, _{0}{1}_ is disabled for now.".format(config.COMMAND_CHAR, content))
+        return
+    
+    # Parse the message once, for the command to use
+    context = bot_utils.CommandContext(msg, content, text.strip())
+    
+    # Hold the command to its own deadline, rather than do_command's
+    timeout = plugin_timeout(func)
+    get_pool().relabel(func, timeout)
+    try:
+        if match is None:
+            result = func(context)
+        else:
+            result = func(context, match)
+    except Exception:
+        logging.exception("Error in command %s", plugin_name(func))
+        record_failure(func, "errors")
+        return
+    
+    # Async commands carry on on the plugin event loop, still in order
+    if bot_utils.is_awaitable(result):
+        import async_utils
+        async_utils.spawn(result, key=(do_command, bot_utils.channel_key(msg)),
+            timeout=timeout, on_failure=partial(record_failure, func))
+
+# Flags a regex has when its pattern sets none itself
+_DEFAULT_FLAGS = re.compile("").flags
+
+# Numbered backreferences, which would point at the wrong group once a
+# regex is wrapped in the combined alternation
+_BACKREF_RE = re.compile(r"\\[1-9]|\\g<\d|\(\?\(\d")
+
+class CommandMatcher(object):
+    """Finds the function for a command word.
+    
+    Exact !commands are looked up first. Failing that, the dynamic
+    commands' regexes are tried in the order they were registered, with
+    all of them that can be tried at once combined into one compiled
+    alternation. Regexes that can't be combined (they set flags like
+    (?i), or use numbered backreferences) are matched on their own, and
+    ones that don't compile at all are skipped with a warning.
+    """
+    def __init__(self, commands, dynamic):
+        self.commands = dict(commands)
+        self.dynamic = []
+        for entry in dynamic:
+            if not isinstance(entry, tuple):
+                entry = (entry, None)
+            try:
+                regex = re.compile(entry[0])
+            except (re.error, TypeError) as err:
+                logging.warning("Skipping bad dynamic command regex %r (for %s): %s",
+                    entry[0], plugin_name(entry[1]) if entry[1] else "RECOMMANDS", err)
+                continue
+            self.dynamic.append((regex, entry[1]))
+        
+        # Indexes into self.dynamic of the regexes matched on their own
+        self.separate = []
+        combinable = []
+        names = set()
+        for idx, (regex, _) in enumerate(self.dynamic):
+            if regex.flags != _DEFAULT_FLAGS or _BACKREF_RE.search(regex.pattern) \
+                    or names.intersection(regex.groupindex):
+                self.separate.append(idx)
+            else:
+                names.update(regex.groupindex)
+                combinable.append(idx)
+        self.combined = None
+        if combinable:
+            # Wrap each regex in a named group, to tell which one matched
+            try:
+                self.combined = re.compile("|".join(
+                    "(?P<_%d>%s)" % (idx, self.dynamic[idx][0].pattern) for idx in combinable))
+            except re.error as err:
+                logging.warning("Can't combine the dynamic command regexes, matching each on its own: %s", err)
+                self.separate = list(range(len(self.dynamic)))
+    
+    def match(self, word):
+        """Return (function, match) for a command word, or None.
+        
+        `match` is the dynamic command's regex match, or None for exact
+        commands. `function` is None for bare RECOMMANDS regexes.
+        """
+        func = self.commands.get(word)
+        if func is not None:
+            return func, None
+        first = len(self.dynamic)
+        if self.combined is not None:
+            found = self.combined.match(word)
+            if found:
+                first = int(found.lastgroup[1:])
+        # A regex registered before the combined one that matched wins
+        for idx in self.separate:
+            if idx > first:
+                break
+            found = self.dynamic[idx][0].match(word)
+            if found:
+                return self.dynamic[idx][1], found
+        if first < len(self.dynamic):
+            regex, func = self.dynamic[first]
+            return func, regex.match(word)
+        return None
+
+# Dispatch tables, built from bot_utils' registries by rebuild() once the
+# plugins are loaded. Each is replaced whole, never changed in place, so
+# a reload can't leave them half-updated.
+MATCHER = None
+# (event type -> ((handler, key function, timeout, name), ...), the same
+# for any other event type)
+ROUTES = None
+
+def rebuild():
+    """(Re)build the command matcher and event routes from the registered
+    commands and handlers.
+    """
+    global MATCHER, ROUTES
+    handlers = [((func, bot_utils.HANDLER_KEYS.get(func), plugin_timeout(func), plugin_name(func)),
+        bot_utils.HANDLER_EVENTS.get(func)) for func in bot_utils.HANDLERS]
+    catch_all = tuple(route for route, events in handlers if events is None)
+    by_event = {}
+    for route, events in handlers:
+        for event in events or ():
+            by_event.setdefault(event, list(catch_all)).append(route)
+    MATCHER = CommandMatcher(bot_utils.COMMANDS, bot_utils.RECOMMANDS)
+    ROUTES = (dict((event, tuple(routes)) for event, routes in by_event.items()), catch_all)
+
+def get_matcher():
+    """Return the command matcher, building it if need be."""
+    if MATCHER is None:
+        rebuild()
+    return MATCHER
+
+# Rate limits on !commands, built from config by the first command:
+# (per user, per channel, command word -> per user), None for no limit
+LIMITS = None
+_LIMITS_LOCK = threading.Lock()
+
+def get_limits():
+    """Return the command rate limits, building them if need be."""
+    global LIMITS
+    with _LIMITS_LOCK:
+        if LIMITS is None:
+            def buckets(limit, name):
+                if not limit:
+                    return None
+                return ratelimit.TokenBuckets(limit[0], limit[1], name=name)
+            LIMITS = (
+                buckets(getattr(config, "RATE_LIMIT_USER", (10, 20)), "ratelimit.user"),
+                buckets(getattr(config, "RATE_LIMIT_CHANNEL", (30, 20)), "ratelimit.channel"),
+                dict((word, buckets(limit, "ratelimit.command.%s" % word))
+                    for word, limit in getattr(config, "RATE_LIMIT_COMMANDS", {}).items()),
+                )
+    return LIMITS
+
+def rate_limited(msg, word):
+    """Has a command's sender, its channel, or the sender's use of that
+    command word gone over its rate limit? Admins are never limited.
+    """
+    author = msg["d"]["author"].get("id")
+    if author in config.ADMINS:
+        return False
+    by_user, by_channel, by_command = get_limits()
+    command = by_command.get(word)
+    # The sender's own limits first, so one user flooding a channel
+    # doesn't use up everyone else's share of it
+    return not ((by_user is None or by_user.take(author))
+        and (command is None or command.take(author))
+        and (by_channel is None or by_channel.take(msg["d"].get("channel_id"))))
+
+def wanted_events():
+    """Return the set of event types the loaded handlers need, or None
+    if any of them wants every event.
+    """
+    wanted = set()
+    for events in bot_utils.HANDLER_EVENTS.values():
+        if events is None:
+            return None
+        wanted.update(events)
+    return wanted
+
+# Worker threads that run the handlers, started by the first handle()
+POOL = None
+_POOL_LOCK = threading.Lock()
+
+def get_pool():
+    """Return the handler worker pool, starting it if need be."""
+    global POOL
+    with _POOL_LOCK:
+        if POOL is None:
+            POOL = workerpool.WorkerPool(
+                getattr(config, "PLUGIN_WORKERS", 16),
+                getattr(config, "PLUGIN_QUEUE_SIZE", 1000),
+                name="plugins.pool",
+                on_timeout=lambda func, elapsed: record_failure(func, "timeouts"),
+                max_per_key=getattr(config, "PLUGIN_QUEUE_PER_KEY", None),
+                )
+    return POOL
+
+def has_room():
+    """Can the handlers take another event without dropping any of it?"""
+    return get_pool().has_room()
+
+def plugin_name(func):
+    """Return the name a handler or command goes by in config, metrics
+    and logs: module.function.
+    """
+    return "%s.%s" % (getattr(func, "__module__", None), getattr(func, "__name__", func))
+
+def plugin_timeout(func):
+    """Return how long (in seconds) a handler or command may run for."""
+    timeouts = getattr(config, "PLUGIN_TIMEOUTS", {})
+    return timeouts.get(plugin_name(func), getattr(config, "PLUGIN_TIMEOUT", 30))
+
+# Names (see plugin_name()) of the handlers and commands that failed too
+# often, and are no longer called. Kept by name, so a lazy command's stub
+# and the real command it's replaced by count as one.
+DISABLED = set()
+
+# Handler or command name -> when it last failed, most recent last
+FAILURES = {}
+_FAILURES_LOCK = threading.Lock()
+
+def record_failure(func, reason):
+    """Count an exception ("errors") or overrun deadline ("timeouts") of a
+    handler or command, and disable it if it's failed too often lately.
+    
+    Only timeouts count towards disabling it, unless
+    PLUGIN_DISABLE_ON_ERRORS is set: a command raising on bad input
+    from one user shouldn't turn it off for everyone, whereas one that
+    hangs ties up a worker every time.
+    """
+    name = plugin_name(func)
+    metrics.incr("plugins.%s" % reason)
+    metrics.incr("plugins.%s.%s" % (reason, name))
+    limit = getattr(config, "PLUGIN_MAX_FAILURES", 5)
+    window = getattr(config, "PLUGIN_FAILURE_WINDOW", 300)
+    # do_command runs every command, !enable included, so its own
+    # failures (say, a slow "Unknown command" reply) are only counted
+    if not limit or func is do_command:
+        return
+    if reason == "errors" and not getattr(config, "PLUGIN_DISABLE_ON_ERRORS", False):
+        return
+    now = time.time()
+    with _FAILURES_LOCK:
+        recent = FAILURES.setdefault(name, deque(maxlen=limit))
+        recent.append(now)
+        if name in DISABLED or len(recent) < limit or now - recent[0] > window:
+            return
+        DISABLED.add(name)
+    logging.error("Disabled %s after %s failures in %.0fs, use %senable %s to turn it back on",
+        name, limit, now - recent[0], config.COMMAND_CHAR, name)
+    metrics.incr("plugins.disabled")
+
+def run_handler(plug, msg, key=None, timeout=None):
+    """Call a handler, counting any exception it raises against it.
+    
+    A handler that isn't an `async def` function can still return
+    something to await (say, from a decorator), which carries on on the
+    plugin event loop with the same ordering key and timeout.
+    """
+    try:
+        result = plug(msg)
+    except Exception:
+        logging.exception("Error in handler %s", plugin_name(plug))
+        record_failure(plug, "errors")
+        return
+    if bot_utils.is_awaitable(result):
+        import async_utils
+        async_utils.spawn(result, key=key, timeout=timeout,
+            on_failure=partial(record_failure, plug))
 
 def handle(msg):
-    """Distribute a received message to all relevant plugins."""
-    # TODO: More graceful handling of errors
-    for plug in bot_utils.HANDLERS:
-        th = threading.Thread(target=plug, args=[msg])
-        th.setDaemon(True)
-        th.start()
-
-def load(directory, package=None):
-    """Load plugins from the given directory."""
-    files = os.listdir(directory)
-    for fname in files:
+    """Distribute a received message to the plugins that want its event type.
+    
+    Each handler sees the events with the same ordering key (normally
+    the channel) one at a time, in order.
+    """
+    metrics.incr("plugins.dispatched")
+    pool = get_pool()
+    if ROUTES is None:
+        rebuild()
+    by_event, catch_all = ROUTES
+    for plug, key, timeout, name in by_event.get(msg.get("t"), catch_all):
+        if name in DISABLED:
+            continue
+        if key is not None:
+            key = key(msg)
+            if key is not None:
+                key = (plug, key)
+        if bot_utils.is_async(plug):
+            import async_utils
+            async_utils.spawn(plug(msg), key=key, timeout=timeout,
+                on_failure=partial(record_failure, plug))
+        else:
+            pool.submit(run_handler, plug, msg, key, timeout, key=key, timeout=timeout, label=plug)
+
+# Loaded plugin modules: module name -> (file name, modification time)
+MODULES = {}
+
+# Directories plugins have been loaded from
+DIRECTORIES = []
+
+# The bot_utils registries that plugins add to when they're imported
+REGISTRIES = ("COMMANDS", "RECOMMANDS", "HANDLERS", "HANDLER_EVENTS", "HANDLER_KEYS")
+
+_RELOAD_LOCK = threading.Lock()
+
+def find_plugins(directory, package=None):
+    """Yield (module name, file name) for every plugin module in the
+    given directory, in the order they should be loaded.
+    
+    Packages are given by their directory, just before their modules.
+    """
+    for fname in os.listdir(directory):
         fname = os.path.abspath(os.path.join(directory, fname))
         
-        # If we find a directory, attempt to import it as a package
+        # If we find a directory, treat it as a package if it is one
         if os.path.isdir(fname):
-            logging.debug("Attempting package %s", fname)
-            try:
-                triple = imp.find_module(os.path.basename(fname), [os.path.dirname(fname)])
-                imp.load_module(os.path.basename(fname), *triple)
-            except ImportError:
-                # If it isn't a package, just load any modules within
-                load(fname)
+            if os.path.exists(os.path.join(fname, "__init__.py")):
+                yield os.path.basename(fname), fname
+                for found in find_plugins(fname, package=os.path.basename(fname)):
+                    yield found
             else:
-                # If we loaded it as a package, import modules as a package
-                load(fname, package=os.path.basename(fname))
+                # If it isn't a package, just load any modules within
+                for found in find_plugins(fname):
+                    yield found
             continue
         # Only load .py files
         elif os.path.basename(fname).startswith("_") or not fname.endswith(".py"):
             continue
         
-        # Import the module
         mname = os.path.basename(fname[:-3])
         if package:
             mname = package + '.' + mname
-        logging.debug("Found module '%s'", mname)
+        yield mname, fname
+
+def modified(fname):
+    """Return when a plugin module (or package) was last changed."""
+    if os.path.isdir(fname):
+        fname = os.path.join(fname, "__init__.py")
+    try:
+        return os.path.getmtime(fname)
+    except OSError:
+        return None
+
+# Module name -> (seconds, bytes) its last import took, and the plugins
+# that failed to import: module name -> the error
+IMPORT_STATS = {}
+FAILED = {}
+
+def compile_plugin(mname, fname):
+    """Read a plugin's code from the bytecode cache, or compile it if it
+    has changed, without running it.
+    
+    Returns (module spec, code), or (None, the exception) if it couldn't
+    be read.
+    """
+    location, search = fname, None
+    if os.path.isdir(fname):
+        location, search = os.path.join(fname, "__init__.py"), [fname]
+    try:
+        spec = importlib_util.spec_from_file_location(mname, location,
+            submodule_search_locations=search)
+        return spec, spec.loader.get_code(mname)
+    except Exception as err:
+        return None, err
+
+def compile_plugins(modules):
+    """Compile several (module name, file name) plugins at once, on a few
+    threads. Returns module name -> compile_plugin()'s result.
+    
+    Only the compiling is done in parallel; the modules are still run one
+    at a time, in order, since they all register into the same places
+    and packages have to be imported before their modules.
+    """
+    if importlib_util is None or not modules:
+        return {}
+    threads = min(len(modules), getattr(config, "PLUGIN_LOAD_THREADS", 4))
+    if threads <= 1:
+        return dict((mname, compile_plugin(mname, fname)) for mname, fname in modules)
+    with futures.ThreadPoolExecutor(threads) as executor:
+        results = executor.map(lambda module: compile_plugin(*module), modules)
+        return dict(zip((mname for mname, _ in modules), results))
+
+def _run_plugin(spec, code):
+    """Run a compiled plugin as a new module, replacing any old version.
+    
+    The old version is left in place if it fails.
+    """
+    module = importlib_util.module_from_spec(spec)
+    previous = sys.modules.get(spec.name)
+    sys.modules[spec.name] = module
+    try:
+        exec(code, module.__dict__)
+    except BaseException:
+        if previous is None:
+            del sys.modules[spec.name]
+        else:
+            sys.modules[spec.name] = previous
+        raise
+    return module
+
+def _load_module(mname, fname):
+    """Import a plugin module with imp, for python 2."""
+    path, name = os.path.split(fname)
+    if not os.path.isdir(fname):
+        name = name[:-3]
+    triple = imp.find_module(name, [path])
+    try:
+        return imp.load_module(mname, *triple)
+    finally:
+        if triple[0]:
+            triple[0].close()
+
+def import_plugin(mname, fname, compiled=None):
+    """Import (or re-import) a plugin module, returning it, or None if
+    it failed to import.
+    
+    `compiled` is the plugin's compile_plugin() result, if it's already
+    been compiled.
+    """
+    logging.debug("Found module '%s'", mname)
+    tracing = tracemalloc is not None and tracemalloc.is_tracing()
+    if tracing:
+        memory = tracemalloc.get_traced_memory()[0]
+    started = time.time()
+    try:
+        if importlib_util is None:
+            module = _load_module(mname, fname)
+        else:
+            spec, code = compiled or compile_plugin(mname, fname)
+            if spec is None:
+                raise code
+            module = _run_plugin(spec, code)
+    except Exception as err:
+        logging.warn("Failed to import module %s: %s %s", fname, type(err), err, exc_info=True)
+        FAILED[mname] = "%s: %s" % (type(err).__name__, err)
+        metrics.incr("plugins.import_failures")
+        return None
+    elapsed = time.time() - started
+    IMPORT_STATS[mname] = (elapsed, tracemalloc.get_traced_memory()[0] - memory if tracing else None)
+    FAILED.pop(mname, None)
+    metrics.set_gauge("plugins.import_ms.%s" % mname, int(elapsed * 1000))
+    MODULES[mname] = (fname, modified(fname))
+    return module
+
+def report_imports(modules):
+    """Log how long the given plugins took to import, slowest first, and
+    which ones failed.
+    """
+    stats = sorted(((IMPORT_STATS[mname], mname) for mname in modules if mname in IMPORT_STATS),
+        reverse=True)
+    for (elapsed, memory), mname in stats:
+        if memory is None:
+            logging.debug("Imported %s in %.1fms", mname, elapsed * 1000)
+        else:
+            logging.debug("Imported %s in %.1fms, using %.1fKB", mname, elapsed * 1000, memory / 1024.0)
+    if stats:
+        logging.info("Imported %s plugins in %.1fms%s, slowest: %s", len(stats),
+            sum(elapsed for (elapsed, _), _ in stats) * 1000,
+            " (slowed down by memory tracing)" if any(memory is not None for (_, memory), _ in stats) else "",
+            ", ".join("%s (%.1fms)" % (mname, elapsed * 1000) for (elapsed, _), mname in stats[:5]))
+    failed = [mname for mname in modules if mname in FAILED]
+    if failed:
+        logging.error("Failed to import plugins: %s",
+            "; ".join("%s (%s)" % (mname, FAILED[mname]) for mname in failed))
+
+# Plugins that haven't been imported yet, only their command stubs
+LAZY = set()
+
+MANIFEST_VERSION = 2
+
+def manifest_path(directory):
+    """Return where the plugin manifest for a directory is kept."""
+    return os.path.join(directory, ".manifest.json")
+
+def read_manifest(directory):
+    """Return the cached module name -> description of the plugins in a
+    directory, or an empty dict if there isn't a usable one.
+    """
+    try:
+        with open(manifest_path(directory)) as mfile:
+            manifest = json.load(mfile)
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest.get("modules") or {}
+
+def write_manifest(directory, modules):
+    """Save the plugin manifest for a directory. It's only a cache, so
+    failing to write it is fine.
+    """
+    fname = manifest_path(directory)
+    try:
+        with open(fname + ".tmp", "w") as mfile:
+            json.dump({"version": MANIFEST_VERSION, "modules": modules}, mfile, indent=1, sort_keys=True)
+        os.rename(fname + ".tmp", fname)
+    except (IOError, OSError, TypeError, ValueError) as err:
+        logging.warn("Failed to write plugin manifest %s: %s %s", fname, type(err), err)
+
+def _describe(mname, registered, plugin_files):
+    """Return the manifest entry for a module, given what it registered
+    when it was imported.
+    
+    A module can be imported lazily if all it provides is !commands.
+    Modules with handlers (which need to see every event), bare command
+    regexes, or nothing registered at all (which must be imported for
+    whatever else they do) are always imported at startup.
+    
+    Commands registered by a second copy of another plugin (e.g. through
+    `from plugins import grillme`) are left to that plugin's own entry.
+    """
+    fname, mtime = MODULES[mname]
+    def ours(entry):
+        owner = _owner(entry)
+        if owner == mname:
+            return True
+        source = getattr(sys.modules.get(owner), "__file__", None)
+        return not source or os.path.splitext(source)[0] + ".py" not in plugin_files
+    registered = dict(registered,
+        COMMANDS=dict((word, func) for word, func in registered["COMMANDS"].items() if ours(func)))
+    dynamic = [entry for entry in registered["RECOMMANDS"] if ours(entry)]
+    lazy = (bool(registered["COMMANDS"] or dynamic)
+        and not registered["HANDLERS"]
+        and not os.path.isdir(fname)
+        and all(isinstance(entry, tuple) and not hasattr(entry[0], "pattern") for entry in dynamic))
+    events = set()
+    for func in registered["HANDLERS"]:
+        events.update(registered["HANDLER_EVENTS"].get(func) or ("*",))
+    return {
+        "file": fname,
+        "mtime": mtime,
+        "lazy": lazy,
+        "commands": dict((word, [func.__name__, func.__doc__]) for word, func in registered["COMMANDS"].items()),
+        "dynamic": [[entry[0], entry[1].__name__, entry[1].__doc__] for entry in dynamic if lazy],
+        "events": sorted(events),
+        }
+
+def _lazy_stub(mname, fname, name, doc, lookup):
+    """Return a stand-in for a command whose module hasn't been imported.
+    
+    The first call imports the module, then passes the call on to the
+    command it registered, found with lookup(). Until then, the stub
+    goes by the command's name, so timeouts and failures are counted
+    against the right plugin.
+    """
+    def stub(msg, *args):
+        _import_lazy(mname, fname)
+        func = lookup()
+        if func is None or func is stub:
+            logging.warn("Plugin %s didn't provide the command it was loaded for", mname)
+            return None
+        return func(msg, *args)
+    stub.__module__ = mname
+    stub.__name__ = str(name)
+    stub.__doc__ = doc
+    return stub
+
+def _find_dynamic(regex):
+    """Return the function registered for a dynamic command regex, or None."""
+    for entry in bot_utils.RECOMMANDS:
+        if isinstance(entry, tuple) and entry[0] == regex:
+            return entry[1]
+    return None
+
+def _register_stubs(mname, entry):
+    """Register stand-ins for a lazy module's commands, from its manifest
+    entry.
+    """
+    fname = entry["file"]
+    for word, (name, doc) in entry["commands"].items():
+        bot_utils.COMMANDS[word] = _lazy_stub(mname, fname, name, doc,
+            lambda word=word: bot_utils.COMMANDS.get(word))
+    for regex, name, doc in entry["dynamic"]:
+        bot_utils.RECOMMANDS.append((regex, _lazy_stub(mname, fname, name, doc,
+            lambda regex=regex: _find_dynamic(regex))))
+    MODULES[mname] = (fname, entry["mtime"])
+    LAZY.add(mname)
+
+def _import_lazy(mname, fname):
+    """Import a lazy module, replacing its stubs with its real commands."""
+    with _RELOAD_LOCK:
+        if mname not in LAZY:
+            # Already imported (or dropped) by someone else
+            return
+        logging.info("Importing plugin %s on first use", mname)
+        registered, _ = _swap_in([(mname, fname)])
+        if registered:
+            LAZY.discard(mname)
+            metrics.incr("plugins.lazy_imports")
+    rebuild()
+
+def load(directory):
+    """Load plugins from the given directory.
+    
+    Plugins that only provide !commands, and haven't changed since the
+    directory's manifest was written, aren't imported until one of their
+    commands is first used.
+    """
+    if directory not in DIRECTORIES:
+        DIRECTORIES.append(directory)
+    cached = read_manifest(directory)
+    manifest = {}
+    with _RELOAD_LOCK:
+        imports = []
+        found = list(find_plugins(directory))
+        for mname, fname in found:
+            entry = cached.get(mname)
+            if (entry and entry.get("lazy") and entry.get("file") == fname
+                    and entry.get("mtime") == modified(fname)):
+                _register_stubs(mname, entry)
+                manifest[mname] = entry
+            else:
+                imports.append((mname, fname))
+        # Measure how much memory each plugin takes, just while loading,
+        # if asked to: tracing slows every allocation down, and so the
+        # import times too
+        trace = (tracemalloc is not None and not tracemalloc.is_tracing()
+            and getattr(config, "PLUGIN_TRACE_MEMORY", False))
+        if trace:
+            tracemalloc.start()
         try:
-            triple = imp.find_module(os.path.basename(fname[:-3]), [os.path.dirname(fname)])
-            module = imp.load_module(mname, *triple)
-        except Exception as err:
-            logging.warn("Failed to import module %s: %s %s", fname, type(err), err)
-            continue
+            registered, _ = _swap_in(imports)
+        finally:
+            if trace:
+                tracemalloc.stop()
+        report_imports([mname for mname, _ in imports])
+        plugin_files = set(fname for _, fname in found)
+        for mname, registries in registered:
+            manifest[mname] = _describe(mname, registries, plugin_files)
+    if manifest != cached:
+        write_manifest(directory, manifest)
+    logging.info("Loaded %s plugins, %s of them lazily", len(manifest), len(LAZY))
+    
+    # Take in any commands and handlers the new plugins registered
+    rebuild()
+
+def _owner(entry):
+    """Return the name of the module that registered a command or handler."""
+    if isinstance(entry, tuple):
+        entry = entry[1]
+    return getattr(entry, "__module__", None)
+
+def _merge(old, registered, replaced):
+    """Combine the registries from before an import with what each newly
+    imported module registered.
+    
+    Everything the `replaced` modules registered before is dropped.
+    """
+    keep = lambda entry: _owner(entry) not in replaced
+    merged = {}
+    merged["COMMANDS"] = dict((word, func) for word, func in old["COMMANDS"].items() if keep(func))
+    # Bare regexes have no owner, so they're always kept
+    merged["RECOMMANDS"] = [entry for entry in old["RECOMMANDS"] if keep(entry)]
+    merged["HANDLERS"] = set(func for func in old["HANDLERS"] if keep(func))
+    for name in ("HANDLER_EVENTS", "HANDLER_KEYS"):
+        merged[name] = dict((func, value) for func, value in old[name].items() if keep(func))
+    
+    for _, new in registered:
+        merged["COMMANDS"].update(new["COMMANDS"])
+        for entry in new["RECOMMANDS"]:
+            if entry not in merged["RECOMMANDS"]:
+                merged["RECOMMANDS"].append(entry)
+        merged["HANDLERS"].update(new["HANDLERS"])
+        merged["HANDLER_EVENTS"].update(new["HANDLER_EVENTS"])
+        merged["HANDLER_KEYS"].update(new["HANDLER_KEYS"])
+    return merged
+
+def _swap_in(modules, removed=()):
+    """Import (or re-import) the given (module name, file name) pairs,
+    then swap their commands and handlers in for whatever they, and the
+    `removed` modules, registered before, all at once.
+    
+    Each module is imported into its own empty registries (see
+    bot_utils.staging()), so the live ones carry on serving commands,
+    help and event routing untouched until the end. A module that fails
+    to import keeps its old registrations.
+    
+    Returns ([(module name, what it registered), ...], the set of module
+    names whose old registrations were dropped). Call with _RELOAD_LOCK
+    held.
+    """
+    old = dict((name, getattr(bot_utils, name)) for name in REGISTRIES)
+    registered = []
+    compiled = compile_plugins(modules)
+    try:
+        for mname, fname in modules:
+            state = None
+            previous = sys.modules.get(mname)
+            if hasattr(previous, "save_state"):
+                try:
+                    state = previous.save_state()
+                except Exception as err:
+                    logging.warn("Failed to save state of %s: %s %s", mname, type(err), err)
+            staged = dict((name, type(old[name])()) for name in REGISTRIES)
+            bot_utils.staging(staged)
+            try:
+                module = import_plugin(mname, fname, compiled.get(mname))
+            finally:
+                bot_utils.staging(None)
+            if module is None:
+                # Keep the old version running
+                continue
+            registered.append((mname, staged))
+            if state is not None and hasattr(module, "restore_state"):
+                try:
+                    module.restore_state(state)
+                except Exception as err:
+                    logging.warn("Failed to restore state of %s: %s %s", mname, type(err), err)
+    finally:
+        replaced = set(removed)
+        replaced.update(mname for mname, _ in registered)
+        merged = _merge(old, registered, replaced)
+        for name in REGISTRIES:
+            setattr(bot_utils, name, merged[name])
+    return registered, replaced
+
+def reload():
+    """Re-import any plugins that have changed since they were loaded,
+    load any new ones, and drop any that have been deleted.
+    
+    The reloaded modules' commands and handlers replace their old ones
+    all at once; until then, the old ones carry on handling events. A
+    module can keep state across a reload by defining save_state(),
+    whose result is passed to the new module's restore_state().
+    
+    Returns the names of the modules that were reloaded or dropped.
+    """
+    with _RELOAD_LOCK:
+        found = []
+        for directory in DIRECTORIES:
+            found.extend(find_plugins(directory))
+        changed = [(mname, fname) for mname, fname in found
+            if MODULES.get(mname) != (fname, modified(fname))]
+        removed = set(MODULES) - set(mname for mname, _ in found)
+        if not changed and not removed:
+            return []
+        
+        _, replaced = _swap_in(changed, removed)
+        report_imports([mname for mname, _ in changed])
+        LAZY.difference_update(replaced)
+        for mname in removed:
+            del MODULES[mname]
+        # Give the new versions a clean slate
+        with _FAILURES_LOCK:
+            for name in list(FAILURES) + list(DISABLED):
+                if name.rsplit(".", 1)[0] in replaced:
+                    FAILURES.pop(name, None)
+                    DISABLED.discard(name)
+        rebuild()
+        logging.info("Reloaded plugins: %s", ", ".join(sorted(replaced)) or "none")
+        metrics.incr("plugins.reloads")
+        return sorted(replaced)
+
+@bot_utils.command("reload")
+@bot_utils.admin_only
+def reload_command(msg):
+    """Reload any plugins that have changed, without reconnecting."""
+    reloaded = reload()
+    if reloaded:
+        bot_utils.reply(msg, "Reloaded: %s" % ", ".join(reloaded))
+    else:
+        bot_utils.reply(msg, "Nothing to reload")
+
+@bot_utils.command("enable")
+@bot_utils.admin_only
+def enable_command(msg):
+    """Turn a handler or command that was disabled for failing too often back on, or list them."""
+    if not msg.text:
+        names = sorted(DISABLED)
+        bot_utils.reply(msg, "Disabled: %s" % ", ".join(names) if names else "Nothing is disabled")
+        return
+    with _FAILURES_LOCK:
+        found = msg.text in DISABLED
+        DISABLED.discard(msg.text)
+        FAILURES.pop(msg.text, None)
+    if found:
+        bot_utils.reply(msg, "Enabled %s" % msg.text)
+    else:
+        bot_utils.reply(msg, "%s isn't disabled" % msg.text)
@@ -21,6 +21,14 @@ else:
 # Games are accessed by concatenating server hostname and channel.
 GAMES = {}
 
+def save_state():
+    """Keep games running across a plugin reload."""
+    return GAMES
+
+def restore_state(games):
+    """Pick up the games saved by save_state()."""
+    GAMES.update(games)
+
 def get_game(msg):
     """Gets the appropriate game for a given server and message."""
     # Key is comprised of <server hostname><channel>
@@ -147,7 +155,7 @@ class Uno_Controller(object):
             # If the person who left was the owner, we need a new owner
             if user == self.owner:
                 self.owner = self.game.get_players()[0].get_identifier()
-            
+        
         except Models.UnoError as err:
             self.view.error_report(err)
     
@@ -166,10 +174,7 @@ class Uno_Controller(object):
     def play(self, msg):
         """Called when a Player tries to play a card."""
         # Initialise some variables
-        if ' ' in msg["d"]["content"]:
-            card = msg["d"]["content"].split(None, 1)[1]
-        else:
-            card = ''
+        card = msg.text
         player = self.get_player(msg)
         
         # Make sure the player is in the game
@@ -2,18 +2,14 @@
 Get a channel's discord ID without having to trawl through JSON.
 """
 
-import re
 import bot_utils
 
 @bot_utils.command("channel")
 def command(msg):
     """Return the Discord ID of the mentioned channel, or the ID of the channel where the message was sent."""
-    content = msg.get("d").get("content")
-    if ' ' in content:
-        arg = content.split()[1]
-        matches = re.match(r'\<\#(\d+)\>', arg)
-        if matches:
-            reply = "Discord channel ID %s" % matches.group(1)
+    if msg.text:
+        if msg.channels:
+            reply = "Discord channel ID %s" % msg.channels[0]
         else:
             reply = "Invalid format"
     else:
@@ -25,11 +21,10 @@ def command(msg):
 @bot_utils.admin_only
 def quitguild(msg):
     """Leave a guild (server)"""
-    content = msg.get("d").get("content")
-    if ' ' in content:
-        guildid = content.split(' ', 1)[1]
-    else:
+    guildid = msg.text
+    if not guildid:
         bot_utils.reply(msg, "channel ID missing")
+        return
     
     bot_utils.HTTP_SESSION.delete("/users/@me/guilds/{guildid}".format(guildid=guildid))
     bot_utils.reply(msg, "Done")
@@ -9,9 +9,8 @@ import config
 @bot_utils.command("help")
 def call(msg):
     """For help with a particular command, type _{cc}help command_."""
-    content = msg.get("d").get("content")
-    if ' ' in content:
-        command = content.split(None)[1].lower().strip(config.COMMAND_CHAR)
+    if msg.args:
+        command = msg.args[0].lower().strip(config.COMMAND_CHAR)
         if command in bot_utils.COMMANDS:
             reply = bot_utils.COMMANDS[command].__doc__ or "No help available"
         else:
@@ -42,11 +42,7 @@ def weightedrand():
 @bot_utils.command("lewd")
 def doit(msg):
     """Measure lewdness of target"""
-    content = msg.get("d").get("content")
-    if ' ' in content:
-        target = content.split(' ', 1)[1].strip()
-    else:
-        target = "<@%s>" % msg["d"]["author"]["id"]
+    target = msg.text or "<@%s>" % msg["d"]["author"]["id"]
     
     try:
         lewdness = MEASUREMENTS[target]
@@ -7,26 +7,24 @@ import logging
 import bot_utils
 import config
 
-@bot_utils.handler
+@bot_utils.handler("MESSAGE_CREATE")
 def handle(msg):
-    if msg.get("t") == "MESSAGE_CREATE":
-        content = msg.get("d").get("content")
-        # Respond to !ping with !pong
-        if content == "!foo":
-            reply = u"!bar"
-        # If the !ping has content attached, match this content in the output
-        elif content.startswith("!foo "):
-            reply = u"!bar " + msg.get("d").get("content").split(' ', 1)[1]
-        else:
-            return
-        bot_utils.reply(msg, reply)
+    content = msg.get("d").get("content")
+    # Respond to !ping with !pong
+    if content == "!foo":
+        reply = u"!bar"
+    # If the !ping has content attached, match this content in the output
+    elif content.startswith("!foo "):
+        reply = u"!bar " + msg.get("d").get("content").split(' ', 1)[1]
+    else:
+        return
+    bot_utils.reply(msg, reply)
 
 @bot_utils.command("ping")
 def command(msg):
     """Reply with {cc}pong, and any args passed to the original {cc}ping."""
-    content = msg.get("d").get("content")
-    if ' ' in content:
-        reply = u"{0}pong {1}".format(config.COMMAND_CHAR, content.split(' ', 1)[1])
+    if msg.text:
+        reply = u"{0}pong {1}".format(config.COMMAND_CHAR, msg.text)
     else:
         reply = u"{0}pong".format(config.COMMAND_CHAR)
     
@@ -4,7 +4,6 @@ import random
 import re
 
 import bot_utils
-import config
 
 
 @bot_utils.command("rng")
@@ -14,17 +13,16 @@ def call(msg):
     If no args given, returns a number between 1 and 100.
     If one arg given, returns a number between 1 and <arg>.
     If two args given, returns a number between <arg1> and <arg2>."""
-    content = msg.get("d").get("content")
-    parts = content.split()
-    if len(parts) == 1:
+    args = msg.args
+    if not args:
         minval = 1
         maxval = 100
-    elif len(parts) == 2:
+    elif len(args) == 1:
         minval = 1
-        maxval = int(parts[1])
+        maxval = int(args[0])
     else:
-        minval = int(parts[1])
-        maxval = int(parts[2])
+        minval = int(args[0])
+        maxval = int(args[1])
     
     if minval > maxval:
         minval, maxval = maxval, minval
@@ -42,29 +40,16 @@ def dicecmd(msg):
     Roll one or more dice, you can specify the number of sides and how many to roll.
     e.g. to roll two D6s: !2d6"""
     
-    # This is just a placeholder for the help command
-    return
+    # This is mostly a placeholder for the help command
+    return all_dice_cmd(msg, re.match(DICE_REGEX, "d6"))
 
 
-bot_utils.RECOMMANDS.append(r"(\d*)d(\d+)")
-@bot_utils.handler
-def all_dice_cmd(msg):
+DICE_REGEX = r"(\d*)d(\d+)"
+@bot_utils.dynamic_command(DICE_REGEX)
+def all_dice_cmd(msg, match):
     """
     The real handler for arbitrary dice rolls
     """
-    if msg.get("t") != "MESSAGE_CREATE":
-        return
-    content = msg.get("d").get("content")
-    
-    if not content.startswith(config.COMMAND_CHAR):
-        return
-    
-    content = content.lstrip(config.COMMAND_CHAR)
-    match = re.match(r"(\d*)d(\d+)", content, re.I)
-    
-    if not match:
-        return
-    
     try:
         sides = int(match.group(2))
         if match.group(1):
@@ -2,16 +2,14 @@
 Send arbitrary messages via bot.
 """
 
-import re
 import bot_utils
 
 @bot_utils.command("say")
 @bot_utils.admin_only
 def command(msg):
     """Send arbitrary commands to the specified destination. Works for channels and @Users."""
-    content = msg.get("d").get("content")
     try:
-        _, dest, response = content.split(None, 2)
+        dest, response = msg.text.split(None, 1)
     except ValueError:
         reply = "Invalid format, expected destination and message."
         bot_utils.reply(msg, reply)
@@ -22,22 +20,20 @@ def command(msg):
         dest = bot_utils.get_dm(dest)
     
     # Dest could be a naked ID or a bracket-wrapped format
-    matches = re.match(r'\<.(\d+)\>', dest)
-    if matches:
-        dest = matches.group(1)
+    dest = bot_utils.parse_id(dest) or dest
     
-    # Hijack the bot_utils.reply function
+    # Hijack the bot_utils.reply function, without changing the message
+    # other plugins see
     fake = dict(msg)
-    fake["d"]["channel_id"] = dest
+    fake["d"] = dict(msg["d"], channel_id=dest)
     bot_utils.reply(fake, response)
 
 @bot_utils.command("blink")
 @bot_utils.admin_only
 def blink(msg):
     """Send arbitrary message to the destination, then delete the message"""
-    content = msg.get("d").get("content")
     try:
-        _, dest, response = content.split(None, 2)
+        dest, response = msg.text.split(None, 1)
     except ValueError:
         reply = "Invalid format, expected destination and message."
         bot_utils.reply(msg, reply)
@@ -48,13 +44,12 @@ def blink(msg):
         dest = bot_utils.get_dm(dest)
     
     # Dest could be a naked ID or a bracket-wrapped format
-    matches = re.match(r'\<.(\d+)\>', dest)
-    if matches:
-        dest = matches.group(1)
+    dest = bot_utils.parse_id(dest) or dest
     
-    # Hijack the bot_utils.reply function
+    # Hijack the bot_utils.reply function, without changing the message
+    # other plugins see
     fake = dict(msg)
-    fake["d"]["channel_id"] = dest
+    fake["d"] = dict(msg["d"], channel_id=dest)
     response = bot_utils.reply(fake, response)
     msg_id = response.json()['id']
     chan_id = response.json()['channel_id']
@@ -346,11 +346,7 @@ AFTERMATH = [
 @bot_utils.command("summon")
 def call(msg):
     """Summon a random loli for you."""
-    content = msg.get("d").get("content")
-    if ' ' in content:
-        thing = content.split(None, 1)[1]
-    else:
-        thing = "loli"
+    thing = msg.text or "loli"
     
     age = "%s year old" % random.randint(5, 15)
     text = "_%s %s %s, with %s %s eyes, %s %s hair, and is %s She %s_" % (
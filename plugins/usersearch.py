@@ -30,8 +30,8 @@ HTTP_KWARGS = getattr(config, "USERSEARCH_HTTP_KWARGS", {})
 def command_search(msg):
     """Return the lolicit profile for the given user."""
     # If we have an argument provided, use that
-    if ' ' in msg["d"].get("content"):
-        nick = msg["d"].get("content").split(None, 1)[1]
+    if msg.text:
+        nick = msg.text
         
         if nick.startswith('<@'):
             # If there's a UID provided, try to alias it (or fail)
@@ -93,11 +93,11 @@ def prettyprint(uinfo):
 @bot_utils.admin_only
 def command_add(msg):
     """Add a new alias for another user."""
-    if msg["d"].get("content").count(" ") < 2:
+    if len(msg.args) < 2:
         bot_utils.reply(msg, "Invalid format")
         return
     
-    _, uid, nick = msg["d"].get("content").split(" ", 2)
+    uid, nick = msg.text.split(None, 1)
     uid = uid.strip('<!@>')
     if not re.match(r'(\d+)', uid):
         bot_utils.reply(msg, "Invalid format")
@@ -111,11 +111,11 @@ def command_add(msg):
 @bot_utils.command("selfalias")
 def command_add(msg):
     """Add a new alias for yourself"""
-    if msg["d"].get("content").count(" ") < 1:
+    if not msg.text:
         bot_utils.reply(msg, "Invalid format")
         return
     
-    _, nick = msg["d"].get("content").split(" ", 1)
+    nick = msg.text
     uid = msg["d"].get("author", {}).get("id")
     
     ALIASES[uid] = nick
@@ -127,11 +127,11 @@ def command_add(msg):
 @bot_utils.admin_only
 def command_del(msg):
     """Remove an alias."""
-    if msg["d"].get("content").count(" ") != 1:
+    if len(msg.args) != 1:
         bot_utils.reply(msg, "Invalid format")
         return
     
-    uid = msg["d"].get("content").split(" ")[1]
+    uid = msg.args[0]
     if not re.match(r'\<\@(\d+)\>', uid):
         bot_utils.reply(msg, "Invalid format")
         return
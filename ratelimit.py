@@ -0,0 +1,60 @@
+"""
+Token-bucket rate limiting.
+
+Each key (a user, a channel, ...) gets a bucket holding up to `count`
+tokens, refilled at `count` tokens per `seconds`. Every action takes a
+token, and is refused if the bucket is empty. So a key can act `count`
+times in a burst, and then `count` times every `seconds` on average.
+
+A bucket is just a (tokens, last updated) pair. A bucket that's been
+idle long enough to fill up again is the same as no bucket at all, so
+full buckets are thrown away every so often, and the limiter only holds
+the keys that have been busy recently.
+"""
+
+import threading
+import time
+
+import metrics
+
+class TokenBuckets(object):
+    """Rate limits any number of keys to `count` actions per `seconds`."""
+    def __init__(self, count, seconds, name="ratelimit"):
+        self.count = float(count)
+        self.rate = count / float(seconds)
+        self.name = name
+        # Key -> (tokens left, when that was)
+        self.buckets = {}
+        self._swept = time.time()
+        self._lock = threading.Lock()
+    
+    def take(self, key, now=None):
+        """Take a token from key's bucket, returning False if it's empty."""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if key in self.buckets:
+                tokens, updated = self.buckets[key]
+                tokens = min(self.count, tokens + (now - updated) * self.rate)
+            else:
+                tokens = self.count
+            
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            
+            if now - self._swept >= self.count / self.rate:
+                self._sweep(now)
+        if not allowed:
+            metrics.incr("%s.limited" % self.name)
+        return allowed
+    
+    def _sweep(self, now):
+        """Forget every bucket that's had time to fill up again."""
+        self._swept = now
+        full = [key for key, (tokens, updated) in self.buckets.items()
+            if tokens + (now - updated) * self.rate >= self.count]
+        for key in full:
+            del self.buckets[key]
+        metrics.set_gauge("%s.buckets" % self.name, len(self.buckets))
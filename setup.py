@@ -22,4 +22,8 @@ setup(
     
     # Requirements for this package
     install_requires=['requests', 'websocket-client'],
+    extras_require={
+        # Needed for the asyncio engine
+        'asyncio': ['aiohttp'],
+        },
     )
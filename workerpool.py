@@ -0,0 +1,273 @@
+"""
+A fixed-size pool of worker threads.
+
+Plugin handlers used to get a new thread each for every event, which
+costs a thread start per handler per event, and lets a burst of events
+start thousands of threads at once. The pool runs them on a fixed number
+of long-lived threads instead, taking work from a bounded queue.
+submit() never blocks, as the caller is the gateway reader, and one
+slow plugin mustn't stop it: a task that doesn't fit is dropped
+(shed) instead. Callers that would rather hold work back than lose it
+can check has_room() first.
+
+Tasks can be submitted with an ordering key. Tasks with the same key run
+one at a time, in the order they were submitted, while tasks with
+different keys (or no key) run in parallel. Plugins use this to see the
+events in each channel one after another, so they can keep per-channel
+state without locking, and without a global lock that would run the
+whole bot one event at a time. Only so many tasks can wait behind each
+key, so one busy or slow channel can't fill the whole queue.
+
+Tasks can also be given a deadline. Python can't kill a thread, so a
+task that overruns it is abandoned instead: the tasks waiting behind it
+with the same key go ahead without it, and a new worker takes its place,
+so one hung plugin can't hold up a channel or slowly take every worker.
+Its thread finishes the task (if it ever does) and then exits. At most
+`size` workers are replaced like this at once, so hung tasks can't
+start threads without limit either.
+
+Pool utilisation and queue wait times are kept in metrics, under the
+pool's name:
+ * <name>.busy (gauge): workers currently running a task
+ * <name>.queued (gauge): tasks waiting for a worker
+ * <name>.stuck (gauge): abandoned tasks still running
+ * <name>.tasks, <name>.wait_ms (counters): tasks started, and the
+   total time they spent queued, for the average wait
+ * <name>.shed (counter): tasks dropped because the queue, or their
+   key's backlog, was full
+ * <name>.timeouts (counter): tasks that overran their deadline
+"""
+
+from collections import deque
+import logging
+import sys
+import threading
+import time
+import traceback
+
+import metrics
+
+# How often (in seconds) to check for tasks past their deadline
+WATCH_INTERVAL = 1
+
+class _Running(object):
+    """A task a worker is running."""
+    __slots__ = ("label", "key", "started", "deadline", "abandoned", "replaced")
+    def __init__(self, label, key, deadline):
+        self.label = label
+        self.key = key
+        self.started = time.time()
+        self.deadline = deadline
+        self.abandoned = False
+        self.replaced = False
+
+class WorkerPool(object):
+    """Runs submitted functions on `size` worker threads.
+    
+    At most `max_queued` tasks wait for a worker at once, and at most
+    `max_per_key` (by default, a tenth of that) behind any one key.
+    `on_timeout`, if set, is called with the label and running time of
+    every task that overruns its deadline.
+    """
+    def __init__(self, size, max_queued, name="pool", on_timeout=None, max_per_key=None):
+        self.size = size
+        self.max_queued = max_queued
+        self.max_per_key = max_per_key or max(1, max_queued // 10)
+        self.name = name
+        self.on_timeout = on_timeout
+        self.busy = 0
+        self.stuck = 0
+        # Tasks waiting, whether ready to run or behind a task with
+        # the same key
+        self.queued = 0
+        # Tasks submitted but not yet finished (or abandoned)
+        self.pending = 0
+        # (key, task) pairs ready to run
+        self._ready = deque()
+        # Key -> tasks waiting for the one running (or ready) to finish
+        self._keyed = {}
+        # Worker thread -> the task it's running
+        self._running = {}
+        self._watchdog = None
+        self._workers = 0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        for _ in range(size):
+            self._start_worker()
+        metrics.set_gauge("%s.size" % name, size)
+    
+    def _start_worker(self):
+        """Start another worker thread."""
+        thread = threading.Thread(target=self._work, name="%s-%s" % (self.name, self._workers))
+        thread.setDaemon(True)
+        thread.start()
+        self._workers += 1
+    
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args) to be run by a worker.
+        
+        Pass `key` to run it only after every task already submitted
+        with the same key has finished, and `timeout` to abandon it if
+        it runs for longer than that many seconds. `label` is what the
+        task is called in logs and passed to on_timeout (func, by
+        default).
+        
+        Returns False, without queueing it, if the queue or the key's
+        backlog is full.
+        """
+        key = kwargs.pop("key", None)
+        timeout = kwargs.pop("timeout", None)
+        label = kwargs.pop("label", func)
+        task = (func, args, time.time(), timeout, label)
+        with self._lock:
+            if self.queued >= self.max_queued or len(self._keyed.get(key, ())) >= self.max_per_key:
+                shed = True
+            else:
+                shed = False
+                self.queued += 1
+                self.pending += 1
+                if key is None:
+                    self._ready.append((None, task))
+                elif key in self._keyed:
+                    self._keyed[key].append(task)
+                else:
+                    self._keyed[key] = deque()
+                    self._ready.append((key, task))
+                if timeout is not None:
+                    self._start_watchdog()
+                self._cond.notify()
+            queued = self.queued
+        if shed:
+            logging.debug("%s full, dropping task %s", self.name, getattr(label, "__name__", label))
+            metrics.incr("%s.shed" % self.name)
+            return False
+        metrics.set_gauge("%s.queued" % self.name, queued)
+        return True
+    
+    def has_room(self):
+        """Is there room in the queue for another task (with no key, or
+        a key with nothing waiting)?
+        """
+        with self._lock:
+            return self.queued < self.max_queued
+    
+    def relabel(self, label, timeout=None):
+        """Rename the task running on the calling thread, and give it a
+        new deadline, `timeout` seconds from now (or none).
+        
+        Lets a task that calls something else (like a plugin command)
+        have that held to its own deadline, and blamed if it overruns.
+        Does nothing outside the pool's workers.
+        """
+        with self._lock:
+            running = self._running.get(threading.current_thread())
+            if running is None:
+                return
+            running.label = label
+            running.deadline = None if timeout is None else time.time() + timeout
+            if timeout is not None:
+                self._start_watchdog()
+    
+    def _work(self):
+        """Worker thread: run tasks until this worker is replaced."""
+        me = threading.current_thread()
+        while True:
+            with self._lock:
+                while not self._ready:
+                    self._cond.wait()
+                key, (func, args, submitted, timeout, label) = self._ready.popleft()
+                self.queued -= 1
+                self.busy += 1
+                busy = self.busy
+                running = self._running[me] = _Running(label, key,
+                    None if timeout is None else time.time() + timeout)
+            metrics.set_gauge("%s.busy" % self.name, busy)
+            metrics.incr("%s.tasks" % self.name)
+            metrics.incr("%s.wait_ms" % self.name, int((time.time() - submitted) * 1000))
+            
+            try:
+                func(*args)
+            except Exception:
+                logging.exception("Error in %s", getattr(running.label, "__name__", running.label))
+            
+            with self._lock:
+                del self._running[me]
+                if running.abandoned:
+                    # The watchdog has already let everything else go on
+                    # without this task
+                    self.stuck -= 1
+                    stuck = self.stuck
+                else:
+                    self.busy -= 1
+                    self.pending -= 1
+                    self._release(key)
+                busy = self.busy
+            if running.abandoned:
+                logging.warn("Abandoned task %s finished after %.1fs",
+                    getattr(running.label, "__name__", running.label), time.time() - running.started)
+                metrics.set_gauge("%s.stuck" % self.name, stuck)
+                if running.replaced:
+                    return
+            metrics.set_gauge("%s.busy" % self.name, busy)
+    
+    def _release(self, key):
+        """Let the next task with this key run. Call with the lock held."""
+        if key is None:
+            return
+        waiting = self._keyed[key]
+        if waiting:
+            self._ready.append((key, waiting.popleft()))
+            self._cond.notify()
+        else:
+            del self._keyed[key]
+    
+    def _start_watchdog(self):
+        """Start the thread that looks for overdue tasks, if it isn't
+        running yet. Call with the lock held.
+        """
+        if self._watchdog is None:
+            self._watchdog = threading.Thread(target=self._watch, name="%s-watchdog" % self.name)
+            self._watchdog.setDaemon(True)
+            self._watchdog.start()
+    
+    def _watch(self):
+        """Watchdog thread: abandon tasks that overrun their deadline."""
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            now = time.time()
+            overdue = []
+            with self._lock:
+                for thread, running in self._running.items():
+                    if running.abandoned or running.deadline is None or now < running.deadline:
+                        continue
+                    running.abandoned = True
+                    self.busy -= 1
+                    self.pending -= 1
+                    self.stuck += 1
+                    self._release(running.key)
+                    # Keep the pool at full strength, within reason
+                    if self.stuck <= self.size:
+                        running.replaced = True
+                        self._start_worker()
+                    overdue.append((thread, running))
+                stuck = self.stuck
+            
+            for thread, running in overdue:
+                metrics.incr("%s.timeouts" % self.name)
+                frame = sys._current_frames().get(thread.ident)
+                logging.error("Task %s has been running for %.1fs, abandoning it%s:\n%s",
+                    getattr(running.label, "__name__", running.label), now - running.started,
+                    "" if running.replaced else " (too many stuck tasks to replace its worker)",
+                    "".join(traceback.format_stack(frame)) if frame else "")
+                if self.on_timeout:
+                    try:
+                        self.on_timeout(running.label, now - running.started)
+                    except Exception:
+                        logging.exception("Error in on_timeout")
+            if overdue:
+                metrics.set_gauge("%s.stuck" % self.name, stuck)
+    
+    def idle(self):
+        """Is every submitted task finished (or abandoned)?"""
+        with self._lock:
+            return not self.pending